@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+
+"""
+Copyright 2024 Justas Lavišius <bucaneer@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import resource
+import multiprocessing
+from time import perf_counter
+import numpy as np
+import shapefile as shpf
+import shapely as shpl
+import polyline
+import polyline_codec
+import generate
+
+def load_geojson_roundtrip (path):
+  return [
+    shpl.from_geojson(json.dumps(sr.shape.__geo_interface__)) if sr.shape.shapeType != shpf.NULL else None
+    for sr in shpf.Reader(path).shapeRecords()
+  ]
+
+def load_native (path):
+  return generate.load_shapes(path, use_cache=False)
+
+def _measure (func_name, args):
+  base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  t = perf_counter()
+  globals()[func_name](*args)
+  seconds = perf_counter() - t
+  peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return seconds, base_rss, peak_rss
+
+def measure (func_name, *args):
+  """ Run a benchmark function in a fresh process, return time and memory use """
+  with multiprocessing.get_context("spawn").Pool(1) as pool:
+    seconds, base_rss, peak_rss = pool.apply(_measure, (func_name, args))
+  return {
+    "seconds": round(seconds, 4),
+    "peak_rss_mb": round(peak_rss / 1024, 1),
+    "peak_rss_delta_mb": round((peak_rss - base_rss) / 1024, 1),
+  }
+
+def bench_load (paths):
+  """ Time both ways of loading shapefiles, checking that they give the
+  same geometries """
+  output = []
+  for path in paths:
+    identical = [
+      a == b
+      for a, b in zip(shpl.to_wkb(load_geojson_roundtrip(path)), shpl.to_wkb(load_native(path)[0]))
+    ]
+    for func_name in ("load_geojson_roundtrip", "load_native"):
+      output.append({"path": path, "method": func_name, "identical": all(identical), **measure(func_name, path)})
+  return output
+
+def load_polylines (path):
+  """ Encoded rings of a compact GeoJSON file and their precision """
+  with open(path, 'r') as f:
+    data = json.load(f)
+  lines = [line for feature in data["features"] for polygon in generate.geometry_rings(feature["geometry"]) for line in polygon]
+  return lines, data.get("precision", 5)
+
+def codec_package (path):
+  lines, precision = load_polylines(path)
+  coordinates = [polyline.decode(line, precision, geojson=True) for line in lines]
+  return [polyline.encode(points, precision, geojson=True) for points in coordinates]
+
+def codec_numpy (path):
+  lines, precision = load_polylines(path)
+  return polyline_codec.encode_rings(polyline_codec.decode_rings(lines, precision), precision)
+
+def bench_polyline (paths):
+  """ Decode and re-encode every ring, checking the output against the input """
+  output = []
+  for path in paths:
+    lines, precision = load_polylines(path)
+    for func_name in ("codec_package", "codec_numpy"):
+      output.append({
+        "path": path,
+        "method": func_name,
+        "rings": len(lines),
+        "identical": globals()[func_name](path) == lines,
+        **measure(func_name, path),
+      })
+  return output
+
+# synthetic fixtures for bench_stages(): district counts at scale 1 are
+# about those of today's maps, which are generated in a Lithuania-sized
+# box in LKS94 metres with a 1 km population grid
+bench_first = "2024_LRS"
+bench_elections = ["2016_LRS", "2019_EP", "2020_LRS", "2024_EP"]
+bench_districts = 1900
+bench_bounds = (305000, 5975000, 680000, 6257000)
+bench_cities = [(582000, 6061000), (497000, 6087000), (321000, 6178000), (456000, 6202000), (526000, 6176000)]
+bench_pop_cell = 1000
+bench_prj = 'PROJCS["LKS94",GEOGCS["GCS_LKS94",DATUM["D_Lithuania_1994",SPHEROID["GRS_1980",6378137.0,298.257222101]],PRIMEM["Greenwich",0.0],UNIT["Degree",0.0174532925199433]],PROJECTION["Transverse_Mercator"],PARAMETER["False_Easting",500000.0],PARAMETER["False_Northing",0.0],PARAMETER["Central_Meridian",24.0],PARAMETER["Scale_Factor",0.9998],PARAMETER["Latitude_Of_Origin",0.0],UNIT["Meter",1.0]]'
+bench_id_fields = ['apg_nr', 'apl_nr', 'pavad']
+
+def write_prj (path):
+  with open("%s.prj" % path, "w") as f:
+    f.write(bench_prj)
+
+def synthetic_map (path, districts, seed):
+  """ Voronoi partition of bench_bounds into districts, denser around
+  bench_cities like the real maps. Returns their ids. """
+  rng = np.random.default_rng(seed)
+  minx, miny, maxx, maxy = bench_bounds
+  n_city = districts * 2 // 5
+  centres = np.array(bench_cities)[rng.integers(0, len(bench_cities), n_city)]
+  points = np.vstack([
+    np.column_stack([rng.uniform(minx, maxx, districts - n_city), rng.uniform(miny, maxy, districts - n_city)]),
+    np.clip(centres + rng.normal(0, 8000, (n_city, 2)), [minx, miny], [maxx, maxy]),
+  ])
+  box = shpl.box(*bench_bounds)
+  cells = shpl.get_parts(shpl.voronoi_polygons(shpl.multipoints(points), extend_to=box))
+  cells = [cell for cell in shpl.intersection(cells, box) if cell.geom_type == "Polygon" and not cell.is_empty]
+
+  w = shpf.Writer(path, shapeType=shpf.POLYGON)
+  for name, kind, size in (('apg_nr', 'N', 10), ('apl_nr', 'N', 10), ('pavad', 'C', 80)):
+    w.field(name, kind, size, 0)
+  ids = []
+  for i, cell in enumerate(cells):
+    record = (i // 30 + 1, i % 30 + 1, "Apylinke %d" % i)
+    w.shape(shpl.orient_polygons(cell, exterior_cw=True).__geo_interface__)
+    w.record(*record)
+    ids.append(":".join(generate.process_id_field(x) for x in record))
+  w.close()
+  write_prj(path)
+  return ids
+
+def synthetic_population (path, seed):
+  """ bench_pop_cell grid over bench_bounds with more people near cities """
+  rng = np.random.default_rng(seed)
+  minx, miny, maxx, maxy = bench_bounds
+  w = shpf.Writer(path, shapeType=shpf.POLYGON)
+  w.field('POP', 'N', 10, 0)
+  for x in range(minx, maxx, bench_pop_cell):
+    for y in range(miny, maxy, bench_pop_cell):
+      distance = min(np.hypot(x - cx, y - cy) for cx, cy in bench_cities)
+      w.poly([[(x, y), (x, y + bench_pop_cell), (x + bench_pop_cell, y + bench_pop_cell), (x + bench_pop_cell, y), (x, y)]])
+      w.record(int(rng.poisson(20 + 5000 * np.exp(-distance / 5000))))
+  w.close()
+  write_prj(path)
+
+def synthetic_results (election, ids, seed):
+  """ Results shaped like get_results() output for districts ids """
+  rng = np.random.default_rng(seed)
+  parties = list(dict.fromkeys(generate.name_map[election].values()))
+  output = {generate.TOTAL: {}}
+  total_voters = 0
+  for rpl_id in ids:
+    votes = rng.dirichlet(np.ones(len(parties))) * 100
+    output[rpl_id] = {party: "%.2f" % vote for party, vote in zip(parties, votes)}
+    output[rpl_id][generate.TURNOUT] = "%.2f" % rng.uniform(30, 80)
+    output[rpl_id][generate.VOTERS] = int(rng.integers(100, 3000))
+    total_voters += output[rpl_id][generate.VOTERS]
+  for party in parties:
+    output[generate.TOTAL][party] = "%.2f" % rng.uniform(0, 20)
+  output[generate.TOTAL][generate.VOTERS] = total_voters
+  output[generate.TOTAL][generate.TURNOUT] = 50.0
+  generate.write_results(generate.get_result_filename(election), output)
+
+def use_fixtures (directory, pop_path):
+  os.chdir(directory)
+  generate.cache_dir = "cache"
+  generate.pop_path = pop_path
+  for election in [bench_first] + bench_elections:
+    generate.shape_paths[election] = "%s.shp" % election
+    generate.id_fields[election] = bench_id_fields
+
+def build_fixtures (directory, pop_path, scale):
+  use_fixtures(directory, pop_path)
+  districts = int(bench_districts * scale)
+  synthetic_map(bench_first, districts, 0)
+  for i, election in enumerate(bench_elections):
+    ids = synthetic_map(election, districts, i + 1)
+    synthetic_results(election, ids, i + 1)
+
+def stage_compare (directory, pop_path, election):
+  use_fixtures(directory, pop_path)
+  shutil.rmtree(generate.cache_dir, ignore_errors=True)
+  generate.compare(bench_first, election)
+
+def stage_popularity (directory, pop_path, election):
+  use_fixtures(directory, pop_path)
+  generate.results_to_popularity(bench_first, election)
+
+def stage_values (directory, pop_path, election):
+  use_fixtures(directory, pop_path)
+  generate.results_to_values(bench_first, election, generate.party_values_MB)
+
+def stage_combine (directory, pop_path):
+  use_fixtures(directory, pop_path)
+  generate.combine(bench_first, bench_elections, "combined.npz")
+
+def stage_csv (directory, pop_path):
+  use_fixtures(directory, pop_path)
+  generate.compact_combine("combined.npz", "data.csv")
+
+def stage_bin (directory, pop_path):
+  use_fixtures(directory, pop_path)
+  generate.compact_binary("combined.npz", "data.bin")
+
+def stage_geojson (directory, pop_path):
+  use_fixtures(directory, pop_path)
+  generate.build_geojson(bench_first)
+
+def bench_stages (scales):
+  """ Time every stage on synthetic fixtures at each scale, a multiple of
+  today's district counts. The population grid stays the same. """
+  output = []
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    pop_path = os.path.join(tmp_dir, "pop")
+    synthetic_population(pop_path, 0)
+    pop_path += ".shp"
+    for scale in map(float, scales):
+      directory = os.path.join(tmp_dir, "%g" % scale)
+      os.makedirs(directory)
+      measure("build_fixtures", directory, pop_path, scale)
+      runs = []
+      for election in bench_elections:
+        runs += [
+          ("compare", election, [generate.get_crosswalk_filename(bench_first, election)]),
+          ("popularity", election, [generate.get_popularity_filename(bench_first, election)]),
+          ("values", election, [generate.get_values_filename(bench_first, election)]),
+        ]
+      runs += [
+        ("combine", None, ["combined.npz"]),
+        ("csv", None, ["data.csv"]),
+        ("bin", None, ["data.bin"]),
+        ("geojson", None, [generate.get_compact_geojson_filename(bench_first)]),
+      ]
+      for name, election, outputs in runs:
+        args = (directory, pop_path) + ((election,) if election else ())
+        output.append({
+          "scale": scale,
+          "districts": int(bench_districts * scale),
+          "stage": name,
+          "election": election,
+          **measure("stage_%s" % name, *args),
+          "output_bytes": sum(os.path.getsize(os.path.join(directory, f)) for f in outputs),
+        })
+  return output
+
+benchmarks = {
+  "load": bench_load,
+  "polyline": bench_polyline,
+  "stages": bench_stages,
+}
+
+default_args = {
+  "load": lambda: sorted(set(generate.shape_paths.values())) + [generate.pop_path],
+  "polyline": lambda: [generate.get_compact_geojson_filename("2024_LRS")],
+  "stages": lambda: ["1", "5", "20"],
+}
+
+if __name__ == "__main__":
+  name = sys.argv[1] if len(sys.argv) > 1 else "load"
+  args = sys.argv[2:] or default_args[name]()
+  json.dump(benchmarks[name](args), sys.stdout, indent=2, ensure_ascii=False)
+  print()
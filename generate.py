@@ -23,17 +23,30 @@ SOFTWARE.
 """
 
 import numpy as np
+import scipy.sparse as sps
+import os
 import urllib
+import urllib.error
+import urllib.parse
+import http.client
+import threading
+import resource
+import cProfile
 import json
+import hashlib
+import struct
+import zipfile
+import shutil
 import shapefile as shpf
 import shapely as shpl
-import pandas as pd
 import re
-from time import time
+from time import sleep, monotonic, perf_counter, process_time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
 import geopandas as gpd
 import csv
-import polyline
-from datetime import date, timedelta
+import polyline_codec
+from datetime import date, datetime, timedelta
+from functools import partial
 
 elections = {
   "2016_LRS": "2016 m. LR Seimo rinkimai",
@@ -59,6 +72,43 @@ shape_paths = {
 # https://open-data-ls-osp-sdg.hub.arcgis.com/datasets/ff7b85eaf2e64032bdb564f878026a7c_21/about
 pop_path = "../gyventojai 2021/Gyventoj%C5%B3_ir_b%C5%ABst%C5%B3_sura%C5%A1ymas_2021%E2%80%94_Gyventojai_(GRID_1km).shp"
 
+# parsed shapefiles are kept here between runs
+cache_dir = "cache"
+
+# elections whose crosswalks are chained through another map's, see
+# compose_crosswalk(), instead of overlaying maps: election -> map, e.g.
+# {"2016_LRS": "2020_LRS"}
+compose_via = {}
+
+# processes encoding map boundaries in build_geojson()
+geo_workers = 1
+
+# simplified map boundaries loaded before the full-detail ones, coarsest
+# first: level name -> (tolerance in geo_crs units, polyline precision)
+geo_levels = {
+  "coarse": (100, 4),
+}
+
+# projection boundaries are simplified in, that of the election
+# shapefiles (LKS94, in metres)
+geo_crs = "EPSG:3346"
+
+# feature properties kept in simplified boundaries besides the index,
+# the ones map tooltips show
+geo_level_properties = ['pavad', 'sav_pav']
+
+# zoom levels of the boundary tile pyramid and the boundaries cut into
+# their tiles: a geo_levels name, or None for full detail. The map draws
+# the coarsest geo_levels topology first and only loads tiles from the
+# lowest zoom here up
+geo_tile_zooms = {
+  10: None,
+}
+
+# number type of stage output tables; np.float32 halves their size
+# at the cost of precision beyond ~7 digits
+table_dtype = np.float64
+
 id_fields = {
   "2016_LRS": ['APG_NUM', 'APL_NUM', 'APL_PAV'],
   "2019_ST": ['sav_num', 'apl_num', 'apl_pav'],
@@ -69,6 +119,8 @@ id_fields = {
   "2024_LRS": ['apg_nr', 'apl_nr', 'pavad'],
 }
 
+vrk_url = "https://www.vrk.lt/statiniai/puslapiai/rinkimai/"
+
 urls = {
   "2016_LRS": {
     "dir": "102/1/",
@@ -767,82 +819,483 @@ election_dates = {
 
 DATE_HALFLIFE = timedelta(days=1461) # 4 years
 
+manifest_file = "manifest.json"
+
 def generate(
   first="2024_LRS",
   election_list=["2016_LRS", "2019_EP", "2020_LRS", "2024_EP"],
   force=False,
-  combine_file="combined.json",
-  csv_file="data.csv"
+  combine_file="combined.npz",
+  csv_file="data.csv",
+  bin_file="data.bin",
+  offline=False,
+  jobs=1,
+  trace_file=None,
+  profile_dir=None,
 ):
-  """ Main method for generating map data """
-  
+  """ Main method for generating map data
+
+  first is the map results are projected onto, or a list of them. The
+  first of them gets combine_file, csv_file and bin_file, the rest
+  files named after them, see get_target_filename().
+
+  Only stages whose inputs changed since the last build are rerun, see
+  get_stages(). With offline, election results are rebuilt from cached
+  VRK responses only, without network access. With jobs > 1, independent
+  stages run concurrently in up to that many worker processes.
+
+  With trace_file, time, memory, I/O and counters of every stage are
+  written there as JSON, see traced_call(). With profile_dir, a cProfile
+  dump of each rebuilt stage is saved there too, except for "io" stages
+  when jobs > 1.
+  """
+  run_stages(get_stages(first, election_list, combine_file, csv_file, bin_file, offline), force, jobs, trace_file, profile_dir)
+  print("All done.")
+
+def stage (name, title, func, args, outputs, inputs=[], sources=[], config=[], kwargs={}, kind="cpu"):
+  """ A build step: func(*args, **kwargs) makes outputs from the upstream
+  files in inputs, the shapefiles in sources and the settings in config.
+  Functions in config are called for the settings they stand for once
+  the inputs exist. kind is "io" for network-bound steps and "cpu" for
+  the rest. """
+  return {
+    "name": name,
+    "title": title,
+    "func": func,
+    "args": args,
+    "kwargs": kwargs,
+    "outputs": outputs,
+    "inputs": inputs,
+    "sources": sources,
+    "config": config,
+    "kind": kind,
+  }
+
+def get_target_filename (filename, first, targets):
+  """ Output file of target map first: filename for the first of targets,
+  and for the rest filename with the map added, e.g. data_2023_ST.csv """
+  if first == targets[0]:
+    return filename
+  base, ext = os.path.splitext(filename)
+  return "%s_%s%s" % (base, first, ext)
+
+def get_stages (first, election_list, combine_file, csv_file, bin_file, offline=False):
+  """ Stages for target map first, or each of a list of them.
+
+  Results are fetched once for all targets. Compare stages of one target
+  share its population grid pieces, and shapefiles are parsed once per
+  process, see load_pop_pieces() and load_shapes().
+  """
+  targets = [first] if isinstance(first, str) else list(first)
+  stages = []
   for election in election_list:
-    print("Getting election results for %s..." % election)
-    try:
-      if force:
-        raise FileNotFoundError
-      with open(get_result_filename(election), 'r') as f:
-        print("skip")
-    except FileNotFoundError as e:
-      get_results(election)
-
-    print("Comparing shapefiles for %s -> %s..." % (election, first))
-    try:
-      if force:
-        raise FileNotFoundError
-      with open(get_compare_filename(first, election), 'r') as f:
-        print("skip")
-    except FileNotFoundError as e:
-      compare(first, election)
-
-    print("Mapping election results to party popularity for %s -> %s..." % (election, first))
-    try:
-      if force:
-        raise FileNotFoundError
-      with open(get_popularity_filename(first, election), 'r') as f:
-        print("skip")
-    except FileNotFoundError as e:
-      results_to_popularity(first, election)
-
-    print("Mapping election results to values for %s -> %s..." % (election, first))
-    try:
-      if force:
-        raise FileNotFoundError
-      with open(get_values_filename(first, election), 'r'):
-        print("skip")
-    except FileNotFoundError as e:
-      results_to_values(first, election, party_values_MB)
+    stages.append(stage(
+      "results:%s" % election,
+      "Getting election results for %s..." % election,
+      get_results, (election,), kwargs={"offline": offline},
+      outputs=[get_result_filename(election)],
+      config=[vrk_url, urls[election], name_map[election]],
+      kind="io",
+    ))
+  for first in targets:
+    stages += get_target_stages(
+      first, election_list,
+      *[get_target_filename(f, first, targets) for f in (combine_file, csv_file, bin_file)],
+    )
+  # crosswalks chained through the same map are shared between targets
+  return list({st["name"]: st for st in stages}.values())
+
+def compare_stage (first, second):
+  return stage(
+    "compare:%s:%s" % (first, second),
+    "Comparing shapefiles for %s -> %s..." % (second, first),
+    compare, (first, second),
+    outputs=[get_crosswalk_filename(first, second)],
+    sources=[shape_paths[first], shape_paths[second], pop_path],
+    config=[id_fields[first], id_fields[second]],
+  )
+
+def get_target_stages (first, election_list, combine_file, csv_file, bin_file):
+  stages = []
+  for election in election_list:
+    result_file = get_result_filename(election)
+    compare_file = get_crosswalk_filename(first, election)
+    via = compose_via.get(election)
+    if via is None or via in (first, election):
+      stages.append(compare_stage(first, election))
+    else:
+      stages.append(compare_stage(first, via))
+      stages.append(compare_stage(via, election))
+      stages.append(stage(
+        "compare:%s:%s" % (first, election),
+        "Composing crosswalk for %s -> %s via %s..." % (election, first, via),
+        compose_crosswalk, (first, via, election),
+        outputs=[compare_file],
+        inputs=[get_crosswalk_filename(first, via), get_crosswalk_filename(via, election)],
+        config=[via],
+      ))
+    stages.append(stage(
+      "popularity:%s:%s" % (first, election),
+      "Mapping election results to party popularity for %s -> %s..." % (election, first),
+      results_to_popularity, (first, election),
+      outputs=[get_popularity_filename(first, election)],
+      inputs=[compare_file, result_file],
+      config=[election_party_alias(election)],
+    ))
+    stages.append(stage(
+      "values:%s:%s" % (first, election),
+      "Mapping election results to values for %s -> %s..." % (election, first),
+      results_to_values, (first, election, party_values_MB),
+      outputs=[get_values_filename(first, election)],
+      inputs=[compare_file, result_file],
+      config=[partial(election_party_values, party_values_MB, election), values],
+    ))
+  stages.append(stage(
+    "combine:%s" % first,
+    "Combining popularity and values for %s..." % first,
+    combine, (first, election_list, combine_file),
+    outputs=[combine_file],
+    inputs=[f for e in election_list for f in (get_popularity_filename(first, e), get_values_filename(first, e))],
+    config=[election_dates, DATE_HALFLIFE, election_list],
+  ))
+  stages.append(stage(
+    "csv:%s" % first,
+    "Generating CSV data file for %s..." % first,
+    compact_combine, (combine_file, csv_file),
+    outputs=[csv_file],
+    inputs=[combine_file],
+  ))
+  stages.append(stage(
+    "bin:%s" % first,
+    "Generating binary data file for %s..." % first,
+    compact_binary, (combine_file, bin_file),
+    outputs=[bin_file],
+    inputs=[combine_file],
+  ))
+  stages.append(stage(
+    "geojson:%s" % first,
+    "Generating compact shapefile for %s..." % first,
+    build_geojson, (first,),
+    outputs=[get_compact_geojson_filename(first)],
+    sources=[shape_paths[first]],
+    config=[id_fields[first]],
+  ))
+  for level in geo_levels:
+    stages.append(stage(
+      "geojson:%s:%s" % (first, level),
+      "Generating %s boundaries for %s..." % (level, first),
+      simplify_geojson, (first, level),
+      outputs=[get_geo_level_filename(first, level)],
+      inputs=[get_compact_geojson_filename(first)],
+      config=[geo_levels[level], geo_crs, geo_level_properties],
+    ))
+  stages.append(stage(
+    "tiles:%s" % first,
+    "Generating boundary tiles for %s..." % first,
+    tile_geojson, (first,),
+    outputs=[get_tile_index_filename(first)],
+    inputs=[get_compact_geojson_filename(first)],
+    config=[geo_tile_zooms, geo_levels, geo_crs, geo_level_properties],
+  ))
+  for level in [None, *geo_levels]:
+    stages.append(stage(
+      "topology:%s:%s" % (first, level or "full"),
+      "Generating %s boundary topology for %s..." % (level or "full", first),
+      topology_geojson, (first, level),
+      outputs=[get_topology_filename(first, level)],
+      inputs=[get_compact_geojson_filename(first)],
+      config=[geo_levels.get(level), geo_crs, geo_level_properties],
+    ))
+  return stages
+
+def file_hash (filename):
+  h = hashlib.sha256()
+  with open(filename, 'rb') as f:
+    for chunk in iter(lambda: f.read(1 << 20), b''):
+      h.update(chunk)
+  return h.hexdigest()
+
+def config_hash (config):
+  return hashlib.sha256(json.dumps(config, ensure_ascii=False, default=str).encode()).hexdigest()
+
+def stage_signature (st):
+  return {
+    "inputs": {f: file_hash(f) for f in st["inputs"]},
+    "sources": {p: source_stamp(p) for p in st["sources"]},
+    "config": config_hash([c() if callable(c) else c for c in st["config"]]),
+  }
 
-  
-  print("Combining popularity and values...")
+def stale_reason (st, signature, manifest, force=False, rebuilt=()):
+  """ Why a stage needs to be rebuilt, or None if it is up to date.
+
+  rebuilt holds the files remade so far in this run. Outputs found
+  without a manifest entry are taken as up to date unless one of the
+  stage's inputs is among them or newer than the outputs.
+  """
+  if force:
+    return "forced"
+  for f in st["outputs"]:
+    if not os.path.exists(f):
+      return "output %s missing" % f
+  if st["name"] not in manifest:
+    oldest = min(os.path.getmtime(f) for f in st["outputs"])
+    for f in st["inputs"]:
+      if f in rebuilt:
+        return "input %s rebuilt" % f
+      if os.path.getmtime(f) > oldest:
+        return "input %s newer than output" % f
+    return None
+  old = manifest[st["name"]]["signature"]
+  if old["config"] != signature["config"]:
+    return "config changed"
+  for key in ("inputs", "sources"):
+    for f, stamp in signature[key].items():
+      if old[key].get(f) != stamp:
+        return "%s %s changed" % (key[:-1], f)
+  return None
+
+def load_manifest ():
+  try:
+    with open(manifest_file, 'r') as f:
+      return json.load(f)
+  except FileNotFoundError:
+    return {}
+
+def save_manifest (manifest):
+  with open(manifest_file, 'w') as f:
+    json.dump(manifest, f, indent=2, ensure_ascii=False)
+
+# upper bounds in seconds of the HTTP latency histogram in traces
+trace_latency_buckets = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+trace_local = threading.local()
+trace_lock = threading.Lock()
+
+def trace_counters ():
+  """ Counters of the stage traced in this thread, None if not tracing """
+  return getattr(trace_local, "counters", None)
+
+def count (name, n=1, counters=None):
+  """ Add n to a counter of the traced stage """
+  counters = counters if counters is not None else trace_counters()
+  if counters is None:
+    return
+  with trace_lock:
+    counters[name] = counters.get(name, 0) + n
+
+def count_latency (name, seconds, counters=None):
+  """ Add a latency to a histogram counter of the traced stage """
+  counters = counters if counters is not None else trace_counters()
+  if counters is None:
+    return
+  bucket = next(("<=%g" % b for b in trace_latency_buckets if seconds <= b), ">%g" % trace_latency_buckets[-1])
+  with trace_lock:
+    histogram = counters.setdefault(name, {"count": 0, "seconds": 0.0, "buckets": dict.fromkeys(["<=%g" % b for b in trace_latency_buckets] + [">%g" % trace_latency_buckets[-1]], 0)})
+    histogram["count"] += 1
+    histogram["seconds"] += seconds
+    histogram["buckets"][bucket] += 1
+
+def io_counters ():
+  """ (bytes read, bytes written) by this process so far, None if unknown """
+  try:
+    with open("/proc/self/io", "r") as f:
+      fields = dict(line.split(": ") for line in f.read().splitlines())
+    return int(fields["rchar"]), int(fields["wchar"])
+  except (OSError, KeyError, ValueError):
+    return None
+
+def reset_peak_rss ():
+  """ Reset the peak RSS of this process, False where that isn't possible """
   try:
-    if force:
-      raise FileNotFoundError
-    with open(combine_file, 'r') as f:
-      print("skip")
-  except FileNotFoundError as e:
-    combine(first, election_list, combine_file)
-
-  print("Generating CSV data file...") 
+    with open("/proc/self/clear_refs", "w") as f:
+      f.write("5")
+    return True
+  except OSError:
+    return False
+
+def rss_mb (field="VmRSS"):
+  """ Current (VmRSS) or peak (VmHWM) RSS of this process, None if unknown """
   try:
-    if force:
-      raise FileNotFoundError
-    with open(csv_file, 'r') as f:
-      print("skip")
-  except FileNotFoundError as e:
-    compact_combine(combine_file, csv_file)
-
-  print("Generating compact shapefile for %s..." % first)
+    with open("/proc/self/status", "r") as f:
+      for line in f:
+        if line.startswith(field + ":"):
+          return round(int(line.split()[1]) / 1024, 1)
+  except (OSError, ValueError):
+    pass
+  return None
+
+def peak_rss_mb ():
+  """ Peak RSS of this process since the last reset_peak_rss() """
+  peak = rss_mb("VmHWM")
+  if peak is None:
+    peak = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+  return peak
+
+def traced_call (name, func, args, kwargs, profile_dir=None):
+  """ Run a stage function and return its trace record.
+
+  Wall and CPU time, bytes read and written and peak RSS cover the whole
+  process, so for "io" stages run in threads next to others they are
+  approximate. peak_rss_scope is "stage" where the peak can be reset
+  before the stage (Linux) and "process", the peak over the life of the
+  process, elsewhere. start_rss_mb is what the process held already, as
+  worker processes keep parsed shapefiles between stages. Counters are those added with count() and
+  count_latency() by the stage's thread and the fetchers it creates.
+  """
+  trace_local.counters = counters = {}
+  peak_reset = reset_peak_rss()
+  start_rss = rss_mb()
+  io_start = io_counters()
+  wall = -perf_counter()
+  cpu = -process_time()
+  profile = cProfile.Profile() if profile_dir is not None else None
   try:
-    if force:
-      raise FileNotFoundError
-    with open(get_compact_geojson_filename(first), 'r') as f:
-      print("skip")
-  except FileNotFoundError as e:
-    shape_to_geojson(first)
-    compact_geojson(first)
+    if profile is not None:
+      profile.runcall(func, *args, **kwargs)
+    else:
+      func(*args, **kwargs)
+  finally:
+    wall += perf_counter()
+    cpu += process_time()
+    trace_local.counters = None
+  io_end = io_counters()
+  record = {
+    "wall_seconds": round(wall, 4),
+    "cpu_seconds": round(cpu, 4),
+    "start_rss_mb": start_rss,
+    "peak_rss_mb": peak_rss_mb(),
+    "peak_rss_scope": "stage" if peak_reset else "process",
+    "read_bytes": io_end[0] - io_start[0] if io_start and io_end else None,
+    "written_bytes": io_end[1] - io_start[1] if io_start and io_end else None,
+    "counters": counters,
+  }
+  if profile is not None:
+    os.makedirs(profile_dir, exist_ok=True)
+    record["profile"] = os.path.join(profile_dir, "%s.prof" % re.sub("\\W", "_", name))
+    profile.dump_stats(record["profile"])
+  return record
+
+def write_trace (trace_file, trace):
+  with open(trace_file, 'w') as f:
+    json.dump(trace, f, indent=2, ensure_ascii=False)
+
+def run_stages (stages, force=False, jobs=1, trace_file=None, profile_dir=None):
+  """ Run stages in dependency order, skipping those that are up to date.
+
+  Each stage's input signature and the reason it was last rebuilt are
+  kept in manifest_file. Outputs that exist without a manifest entry are
+  taken as up to date. With jobs > 1, a stage starts as soon as the
+  stages producing its inputs are done: "io" stages in threads, "cpu"
+  stages in a pool of jobs processes.
+
+  With trace_file, a record of every stage is written there as JSON.
+  """
+  manifest = load_manifest()
+  producers = {f: st["name"] for st in stages for f in st["outputs"]}
+  deps = {st["name"]: {producers[f] for f in st["inputs"] if f in producers} for st in stages}
+  pending = list(stages)
+  running = {}
+  done = set()
+  rebuilt = set()
+  trace = {"started": datetime.now().isoformat(timespec="seconds"), "jobs": jobs, "stages": []} if trace_file is not None else None
+  wall = -perf_counter()
+
+  def trace_stage (st, built, reason, record=None):
+    if trace is None:
+      return
+    trace["stages"].append({
+      "name": st["name"],
+      "kind": st["kind"],
+      "built": built,
+      "reason": reason,
+      **(record or {}),
+      "output_bytes": sum(os.path.getsize(f) for f in st["outputs"] if os.path.exists(f)),
+    })
+    write_trace(trace_file, trace)
+
+  def finish (st, signature, reason, built=True, record=None):
+    trace_stage(st, built, reason, record)
+    if built:
+      rebuilt.update(st["outputs"])
+    built = datetime.now().isoformat(timespec="seconds") if built else None
+    manifest[st["name"]] = {"signature": signature, "reason": reason, "built": built}
+    save_manifest(manifest)
+    done.add(st["name"])
+
+  def call (st):
+    if trace is None:
+      return st["func"], (*st["args"],), st["kwargs"]
+    # only one profiler can be active per process, so "io" stages sharing
+    # the main process as threads aren't profiled
+    profile = profile_dir if cpu_pool is None or st["kind"] != "io" else None
+    return traced_call, (st["name"], st["func"], st["args"], st["kwargs"], profile), {}
+
+  io_pool = ThreadPoolExecutor(max(jobs, 1))
+  cpu_pool = ProcessPoolExecutor(jobs, initializer=set_config, initargs=(get_config(),)) if jobs > 1 else None
+  try:
+    while pending or running:
+      ready = [st for st in pending if deps[st["name"]] <= done]
+      if cpu_pool is None:
+        # one at a time, in the order the stages were given
+        ready = ready[:1]
+      for st in ready:
+        pending.remove(st)
+        print(st["title"])
+        signature = stage_signature(st)
+        reason = stale_reason(st, signature, manifest, force, rebuilt)
+        if reason is None:
+          print("skip")
+          if st["name"] not in manifest:
+            finish(st, signature, "existing output adopted", built=False)
+          else:
+            trace_stage(st, False, None)
+          done.add(st["name"])
+          continue
+        print("rebuild: %s" % reason)
+        func, args, kwargs = call(st)
+        if cpu_pool is None:
+          record = func(*args, **kwargs)
+          finish(st, signature, reason, record=record if trace is not None else None)
+          continue
+        pool = io_pool if st["kind"] == "io" else cpu_pool
+        running[pool.submit(func, *args, **kwargs)] = (st, signature, reason)
+      if not running:
+        if pending and not any(deps[st["name"]] <= done for st in pending):
+          raise RuntimeError("Unsatisfiable stage dependencies: %s" % ", ".join(st["name"] for st in pending))
+        continue
+      finished, _ = wait(running, return_when=FIRST_COMPLETED)
+      for future in finished:
+        st, signature, reason = running.pop(future)
+        record = future.result()
+        print("done: %s" % st["title"])
+        finish(st, signature, reason, record=record if trace is not None else None)
+  finally:
+    io_pool.shutdown()
+    if cpu_pool is not None:
+      cpu_pool.shutdown()
+    if trace is not None:
+      trace["wall_seconds"] = round(wall + perf_counter(), 4)
+      write_trace(trace_file, trace)
+
+# settings carried over to worker processes: every module setting a
+# stage reads belongs here, or changing it at runtime won't reach stages
+# run with jobs > 1 under the spawn and forkserver start methods
+config_names = [
+  "elections", "shape_paths", "pop_path", "id_fields", "urls", "vrk_url",
+  "name_map", "party_alias", "values", "party_values_MB",
+  "party_values_CHES", "election_dates", "DATE_HALFLIFE", "cache_dir",
+  "manifest_file", "compose_via", "geo_workers", "geo_levels", "geo_crs",
+  "geo_level_properties", "geo_tile_zooms", "table_dtype",
+  "trace_latency_buckets", "fetch_workers", "fetch_retries",
+  "fetch_backoff", "fetch_rate", "fetch_timeout",
+]
 
-  print("All done.")
+def get_config ():
+  return {k: globals()[k] for k in config_names}
+
+def set_config (config):
+  """ Carry settings changed at runtime over to worker processes """
+  globals().update(config)
 
 def pav_to_slug (string):
   return re.sub("\\W", "", string).lower()
@@ -867,11 +1320,622 @@ def bbox_check (sr1, sr2):
 def sum_attr (_list, attr):
   return sum([x[attr] for x in _list])
 
+def sidecar_path (path, ext):
+  base, shp_ext = os.path.splitext(path)
+  return base + (ext.upper() if shp_ext.isupper() else ext)
+
+def read_shp_geoms (path):
+  """ Read polygon shapes from a .shp file straight into a shapely array.
+
+  Rings are grouped into (multi)polygons the same way as pyshp's
+  __geo_interface__ does, so the result matches parsing that as GeoJSON.
+  """
+  shx = np.fromfile(sidecar_path(path, ".shx"), dtype=np.uint8)
+  buf = np.fromfile(path, dtype=np.uint8)
+
+  def gather (offsets, dtype):
+    size = np.dtype(dtype).itemsize
+    return buf[offsets[:, None] + np.arange(size)].view(dtype).ravel()
+
+  offsets = shx[100:].view('>i4').reshape(-1, 2)[:, 0].astype(np.int64) * 2 + 8
+  shape_type = gather(offsets, '<i4')
+  null = shape_type == 0
+  # null shapes have no part or point counts to read
+  num_parts = np.zeros(len(offsets), dtype=np.int32)
+  num_points = np.zeros(len(offsets), dtype=np.int32)
+  num_parts[~null] = gather(offsets[~null] + 36, '<i4')
+  num_points[~null] = gather(offsets[~null] + 40, '<i4')
+
+  shape_of_ring = np.repeat(np.arange(len(offsets)), num_parts)
+  first_ring = np.cumsum(num_parts) - num_parts
+  ring_in_shape = np.arange(len(shape_of_ring)) - first_ring[shape_of_ring]
+  part_start = gather(offsets[shape_of_ring] + 44 + 4 * ring_in_shape, '<i4')
+  point_start = offsets + 44 + 4 * num_parts
+  coords = np.concatenate([buf[a:a + 16 * n] for a, n in zip(point_start, num_points)] + [buf[:0]])
+  coords = coords.view('<f8').reshape(-1, 2)
+
+  ring_start = (np.cumsum(num_points) - num_points)[shape_of_ring] + part_start
+  ring_size = np.diff(np.append(ring_start, len(coords)))
+  rings = shpl.linearrings(coords, indices=np.repeat(np.arange(len(ring_start)), ring_size))
+  exterior = ~shpl.is_ccw(rings)
+
+  num_exteriors = np.bincount(shape_of_ring[exterior], minlength=len(offsets))
+  num_holes = num_parts - num_exteriors
+  single = num_exteriors[shape_of_ring] == 1
+  separate = ((num_exteriors == 0) | (num_holes == 0))[shape_of_ring] & ~single
+  nested = ~(single | separate)
+
+  # one polygon per shape with the exterior ring first, or one per ring
+  order = np.lexsort((~exterior, shape_of_ring))
+  order = order[(single | separate)[order]]
+  new_poly = ~single[order] | exterior[order]
+  poly_idx = np.cumsum(new_poly) - 1
+  polys = shpl.polygons(rings[order], indices=poly_idx)
+  shape_of_poly = shape_of_ring[order][new_poly]
+
+  geoms = np.full(len(offsets), None, dtype=object)
+  polys_per_shape = np.bincount(shape_of_poly, minlength=len(offsets))
+  one = polys_per_shape[shape_of_poly] == 1
+  geoms[shape_of_poly[one]] = polys[one]
+  if np.any(~one):
+    multi_shapes, multi_idx = np.unique(shape_of_poly[~one], return_inverse=True)
+    geoms[multi_shapes] = shpl.multipolygons(polys[~one], indices=multi_idx)
+
+  for i in np.unique(shape_of_ring[nested]):
+    ring_coords = [shpl.get_coordinates(r).tolist() for r in rings[shape_of_ring == i]]
+    polys = [shpl.Polygon(p[0], p[1:]) for p in shpf.organize_polygon_rings(ring_coords)]
+    geoms[i] = polys[0] if len(polys) == 1 else shpl.MultiPolygon(polys)
+
+  return geoms
+
+def read_shapes (path):
+  geoms = read_shp_geoms(path)
+  sf = shpf.Reader(path)
+  fields = [f[0] for f in sf.fields[1:]]
+  records = sf.records()
+  sf.close()
+  columns = {}
+  for i, k in enumerate(fields):
+    columns[k] = np.empty(len(records), dtype=object)
+    columns[k][:] = [r[i] for r in records]
+  return geoms, columns
+
+def source_stamp (path):
+  """ Identify a shapefile version by path, size and mtime of its parts """
+  stamp = []
+  for p in (path, sidecar_path(path, ".shx"), sidecar_path(path, ".dbf")):
+    st = os.stat(p)
+    stamp.append([os.path.abspath(p), st.st_size, st.st_mtime_ns])
+  return json.dumps(stamp, ensure_ascii=False)
+
+def get_shape_cache_filename (path):
+  key = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:16]
+  return os.path.join(cache_dir, "shapes_%s_%s.npz" % (os.path.basename(os.path.splitext(path)[0]), key))
+
+def write_shape_cache (filename, stamp, geoms, columns):
+  wkb = shpl.to_wkb(geoms)
+  sizes = np.array([len(b) if b is not None else 0 for b in wkb], dtype=np.int64)
+  os.makedirs(cache_dir, exist_ok=True)
+  tmp_filename = "%s.%d.tmp.npz" % (filename, os.getpid())
+  np.savez(
+    tmp_filename,
+    stamp=np.array(stamp),
+    wkb=np.frombuffer(b''.join([b for b in wkb if b is not None]), dtype=np.uint8),
+    wkb_offsets=np.append(0, np.cumsum(sizes)),
+    columns=np.array(json.dumps({k: v.tolist() for k, v in columns.items()}, ensure_ascii=False, default=str)),
+  )
+  os.replace(tmp_filename, filename)
+
+def read_shape_cache (filename, stamp):
+  try:
+    data = np.load(filename)
+  except (FileNotFoundError, ValueError, OSError):
+    return None
+  with data:
+    if str(data["stamp"]) != stamp:
+      return None
+    wkb = data["wkb"].tobytes()
+    offsets = data["wkb_offsets"].tolist()
+    columns = json.loads(str(data["columns"]))
+  geoms = np.full(len(offsets) - 1, None, dtype=object)
+  present = [i for i in range(len(geoms)) if offsets[i + 1] > offsets[i]]
+  geoms[present] = shpl.from_wkb([wkb[offsets[i]:offsets[i + 1]] for i in present])
+  for k, v in columns.items():
+    columns[k] = np.empty(len(v), dtype=object)
+    columns[k][:] = v
+  return geoms, columns
+
+_shape_cache = {}
+
+def load_shapes (path, fields=None, use_cache=True):
+  """ Load a polygon shapefile as (geometries, columns).
+
+  Geometries are a shapely array, columns a dict of attribute arrays
+  for the requested fields (all fields by default). Unless use_cache is
+  off, parsed shapefiles are kept in memory and in cache_dir until the
+  source files change.
+  """
+  if not use_cache:
+    geoms, columns = read_shapes(path)
+  else:
+    stamp = source_stamp(path)
+    if path in _shape_cache and _shape_cache[path][0] == stamp:
+      geoms, columns = _shape_cache[path][1:]
+    else:
+      filename = get_shape_cache_filename(path)
+      cached = read_shape_cache(filename, stamp)
+      if cached is None:
+        geoms, columns = read_shapes(path)
+        write_shape_cache(filename, stamp, geoms, columns)
+      else:
+        geoms, columns = cached
+      _shape_cache[path] = (stamp, geoms, columns)
+  if fields is not None:
+    columns = {k: columns[k] for k in fields}
+  return geoms, columns
+
+_tree_cache = {}
+
+def load_tree (path):
+  """ STRtree over the geometries of a shapefile, kept in memory per source version """
+  geoms, columns = load_shapes(path, [])
+  stamp = source_stamp(path)
+  if path not in _tree_cache or _tree_cache[path][0] != stamp:
+    _tree_cache[path] = (stamp, shpl.STRtree(geoms))
+  return _tree_cache[path][1]
+
+def record_ids (columns, fields):
+  return [':'.join([process_id_field(x) for x in row]) for row in zip(*[columns[k] for k in fields])]
+
 def get_compare_filename (first, second):
   return "compare_%s_%s.json" % (first, second)
 
-def compare (first, second):
-  t = -time()
+def get_crosswalk_filename (first, second):
+  return "compare_%s_%s.npz" % (first, second)
+
+def load_arrays (filename, mmap=True, names=None):
+  """ Load the arrays saved in an uncompressed .npz file.
+
+  With mmap on, numeric members are memory-mapped in place instead of
+  being read into memory. Compressed members are read as usual. names
+  limits loading to the given members.
+  """
+  output = {}
+  with zipfile.ZipFile(filename) as zf, open(filename, 'rb') as raw:
+    for info in zf.infolist():
+      name = info.filename[:-4] if info.filename.endswith('.npy') else info.filename
+      if names is not None and name not in names:
+        continue
+      with zf.open(info) as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+          shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+          shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        if not mmap or info.compress_type != zipfile.ZIP_STORED or dtype.hasobject:
+          f.seek(0)
+          output[name] = np.lib.format.read_array(f, allow_pickle=False)
+          continue
+        header_len = f.tell()
+      raw.seek(info.header_offset)
+      local_header = raw.read(30)
+      name_len, extra_len = struct.unpack('<HH', local_header[26:30])
+      offset = info.header_offset + 30 + name_len + extra_len + header_len
+      if not np.prod(shape):
+        output[name] = np.empty(shape, dtype=dtype)
+        continue
+      output[name] = np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=shape, order='F' if fortran_order else 'C')
+  return output
+
+def encode_ids (ids):
+  """ ID table as newline-separated UTF-8 bytes """
+  return np.frombuffer("\n".join(ids).encode('utf8'), dtype=np.uint8)
+
+def decode_ids (data):
+  return data.tobytes().decode('utf8').split("\n") if len(data) else []
+
+def write_crosswalk (filename, first_ids, second_ids, indptr, indices, area_fraction, pop_fraction):
+  """ Save a crosswalk as sparse CSR arrays with its ID tables """
+  tmp_filename = "%s.%d.tmp.npz" % (filename, os.getpid())
+  np.savez(
+    tmp_filename,
+    first_ids=encode_ids(first_ids),
+    second_ids=encode_ids(second_ids),
+    indptr=np.asarray(indptr, dtype=np.int64),
+    indices=np.asarray(indices, dtype=np.int32),
+    area_fraction=np.asarray(area_fraction, dtype=float),
+    pop_fraction=np.asarray(pop_fraction, dtype=float),
+  )
+  os.replace(tmp_filename, filename)
+
+def index_ids (ids):
+  """ Unique ids in order of appearance and the position of each of ids among them """
+  unique = {}
+  indices = [unique.setdefault(i, len(unique)) for i in ids]
+  return list(unique), indices
+
+def crosswalk_arrays (compare_data):
+  """ CSR arrays of a crosswalk given as {first_id: [{id, area_fraction, pop_fraction}, ...]} """
+  items = [item for first_items in compare_data.values() for item in first_items]
+  second_ids, indices = index_ids([item['id'] for item in items])
+  return (
+    list(compare_data.keys()),
+    second_ids,
+    np.append(0, np.cumsum([len(first_items) for first_items in compare_data.values()])),
+    indices,
+    [item['area_fraction'] for item in items],
+    [item['pop_fraction'] for item in items],
+  )
+
+def convert_crosswalk (first, second):
+  """ Convert a compare_*.json crosswalk to the binary format """
+  with open(get_compare_filename(first, second), 'r') as f:
+    compare_data = json.load(f)
+  write_crosswalk(get_crosswalk_filename(first, second), *crosswalk_arrays(compare_data))
+
+def export_crosswalk (first, second):
+  """ Write a binary crosswalk out as compare_*.json for inspection """
+  with open(get_compare_filename(first, second), 'w') as f:
+    json.dump(dict(crosswalk_items(load_crosswalk(first, second))), f, indent=2)
+
+def load_crosswalk (first, second, mmap=True):
+  """ Crosswalk written by compare() in compressed sparse row form.
+
+  Row i lists the second districts overlapping first_ids[i] as
+  indices[indptr[i]:indptr[i + 1]] into second_ids, with matching
+  area_fraction and pop_fraction values. A JSON crosswalk left by an
+  older run is converted on first use.
+  """
+  filename = get_crosswalk_filename(first, second)
+  if not os.path.exists(filename):
+    convert_crosswalk(first, second)
+  return read_crosswalk(filename, mmap)
+
+def read_crosswalk (filename, mmap=True):
+  crosswalk = load_arrays(filename, mmap)
+  crosswalk["first_ids"] = decode_ids(crosswalk["first_ids"])
+  crosswalk["second_ids"] = decode_ids(crosswalk["second_ids"])
+  return crosswalk
+
+def crosswalk_items (crosswalk):
+  """ Crosswalk rows as (first_id, [{id, area_fraction, pop_fraction}, ...]) """
+  second_ids = crosswalk["second_ids"]
+  indptr = crosswalk["indptr"].tolist()
+  indices = crosswalk["indices"].tolist()
+  area_fraction = crosswalk["area_fraction"].tolist()
+  pop_fraction = crosswalk["pop_fraction"].tolist()
+  for i, first_id in enumerate(crosswalk["first_ids"]):
+    yield first_id, [{
+      "id": second_ids[indices[k]],
+      "area_fraction": area_fraction[k],
+      "pop_fraction": pop_fraction[k],
+    } for k in range(indptr[i], indptr[i + 1])]
+
+def compose_crosswalk_arrays (first_via, via_second):
+  """ Approximate a first → second crosswalk from first → via and
+  via → second ones, as write_crosswalk() arguments.
+
+  This is the sparse product of the two crosswalks' weight matrices,
+  taken for area and population fractions together so both keep one
+  pattern: a first district's share in a via district is split among
+  second districts as that via district is, as if evenly spread over it.
+  Via districts missing from via → second lose their share.
+  """
+  n_second = len(via_second["second_ids"])
+  row_of = {via_id: i for i, via_id in enumerate(via_second["first_ids"])}
+  via_rows = np.array([row_of.get(via_id, -1) for via_id in first_via["second_ids"]], dtype=np.int64)
+  via_indptr = np.asarray(via_second["indptr"])
+  # a trailing empty row for via districts missing from via → second
+  via_lengths = np.append(np.diff(via_indptr), 0)
+
+  # every pair of a first → via entry and an entry of its via row
+  first_rows = np.repeat(np.arange(len(first_via["first_ids"])), np.diff(first_via["indptr"]))
+  rows = via_rows[np.asarray(first_via["indices"])]
+  lengths = via_lengths[rows]
+  a = np.repeat(np.arange(len(rows)), lengths)
+  b = via_indptr[rows[a]] + np.arange(len(a)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+
+  keys = first_rows[a] * n_second + np.asarray(via_second["indices"])[b]
+  keys, inverse = np.unique(keys, return_inverse=True)
+  area_fraction = np.bincount(inverse, np.asarray(first_via["area_fraction"])[a] * np.asarray(via_second["area_fraction"])[b], len(keys))
+  pop_fraction = np.bincount(inverse, np.asarray(first_via["pop_fraction"])[a] * np.asarray(via_second["pop_fraction"])[b], len(keys))
+  first_idx = keys // n_second
+  indptr = np.append(0, np.cumsum(np.bincount(first_idx, minlength=len(first_via["first_ids"]))))
+  return first_via["first_ids"], via_second["second_ids"], indptr, keys % n_second, area_fraction, pop_fraction
+
+def compose_crosswalk (first, via, second):
+  """ Write the first → second crosswalk chained from stored first → via
+  and via → second crosswalks instead of overlaying the maps """
+  arrays = compose_crosswalk_arrays(load_crosswalk(first, via), load_crosswalk(via, second))
+  write_crosswalk(get_crosswalk_filename(first, second), *arrays)
+
+def get_compose_report_filename (first, second):
+  return "compose_%s_%s.json" % (first, second)
+
+def crosswalk_error (approx, exact):
+  """ How far approx is from exact, both loaded crosswalks of the same
+  maps, for each of area_fraction and pop_fraction.
+
+  A district's error is the total variation distance between its rows,
+  the share of its weight that went to the wrong second districts (0 to
+  1).
+  """
+  first_ids = list(dict.fromkeys(list(exact["first_ids"]) + list(approx["first_ids"])))
+  second_ids = list(dict.fromkeys(list(exact["second_ids"]) + list(approx["second_ids"])))
+  first_index = {x: i for i, x in enumerate(first_ids)}
+  second_index = {x: i for i, x in enumerate(second_ids)}
+
+  def entries (crosswalk):
+    rows = np.array([first_index[x] for x in crosswalk["first_ids"]], dtype=np.int64)
+    columns = np.array([second_index[x] for x in crosswalk["second_ids"]], dtype=np.int64)
+    keys = np.repeat(rows, np.diff(crosswalk["indptr"])) * len(second_ids) + columns[np.asarray(crosswalk["indices"], dtype=np.int64)]
+    return keys
+
+  approx_keys, exact_keys = entries(approx), entries(exact)
+  keys, inverse = np.unique(np.concatenate([approx_keys, exact_keys]), return_inverse=True)
+  report = {
+    "first_districts": len(first_ids),
+    "approx_pairs": len(approx_keys),
+    "exact_pairs": len(exact_keys),
+    "spurious_pairs": int(np.setdiff1d(approx_keys, exact_keys).size),
+    "missing_pairs": int(np.setdiff1d(exact_keys, approx_keys).size),
+  }
+  for field in ("area_fraction", "pop_fraction"):
+    diff = np.bincount(inverse, np.concatenate([approx[field], -np.asarray(exact[field])]), len(keys))
+    error = np.bincount(keys // len(second_ids), np.abs(diff), len(first_ids)) / 2
+    report[field] = {
+      "mean": float(error.mean()),
+      "p95": float(np.percentile(error, 95)),
+      "max": float(error.max()),
+      "worst": [first_ids[i] for i in np.argsort(-error)[:5].tolist()],
+    }
+  return report
+
+def compose_report (first, via, second):
+  """ Compare the first → second crosswalk chained through via with the
+  exact overlay, and write times and crosswalk_error() as JSON.
+
+  The exact crosswalk is computed with compare() into cache_dir, leaving
+  any compare_<first>_<second>.npz in place.
+  """
+  t = -perf_counter()
+  approx = compose_crosswalk_arrays(load_crosswalk(first, via), load_crosswalk(via, second))
+  t += perf_counter()
+  approx = dict(zip(["first_ids", "second_ids", "indptr", "indices", "area_fraction", "pop_fraction"], approx))
+
+  os.makedirs(cache_dir, exist_ok=True)
+  exact_filename = os.path.join(cache_dir, os.path.basename(get_crosswalk_filename(first, second)))
+  t_exact = -perf_counter()
+  compare(first, second, filename=exact_filename)
+  t_exact += perf_counter()
+
+  report = {
+    "first": first,
+    "via": via,
+    "second": second,
+    "compose_seconds": round(t, 4),
+    "exact_seconds": round(t_exact, 4),
+    **crosswalk_error(approx, read_crosswalk(exact_filename, mmap=False)),
+  }
+  with open(get_compose_report_filename(first, second), 'w') as f:
+    json.dump(report, f, indent=2, ensure_ascii=False)
+  return report
+
+def write_table (filename, ids, columns, sds={}, sparse=False):
+  """ Save a stage output as a columnar table.
+
+  columns maps column names to arrays aligned with ids, or to lists of
+  strings for text columns. sds maps key names to [mean, sd, min, max].
+  Missing values are NaN (None in text columns); with sparse they stand
+  for keys a row doesn't have rather than for None.
+  """
+  arrays = {"ids": encode_ids(ids)}
+  names = []
+  for name, column in columns.items():
+    if isinstance(column, list) and any(x is None or isinstance(x, str) for x in column):
+      arrays["txt:" + name] = encode_ids(["" if x is None else x for x in column])
+    else:
+      arrays["col:" + name] = np.asarray(column, dtype=table_dtype)
+    names.append(name)
+  for name, stats in sds.items():
+    arrays["sds:" + name] = np.array([np.nan if x is None else x for x in stats], dtype=table_dtype)
+  meta = {"columns": names, "sds": list(sds), "sparse": sparse}
+  arrays["meta"] = np.frombuffer(json.dumps(meta, ensure_ascii=False).encode('utf8'), dtype=np.uint8)
+  tmp_filename = "%s.%d.tmp.npz" % (filename, os.getpid())
+  np.savez(tmp_filename, **arrays)
+  os.replace(tmp_filename, filename)
+
+def read_table_meta (filename):
+  return json.loads(load_arrays(filename, names=["meta"])["meta"].tobytes().decode('utf8'))
+
+def table_columns (filename):
+  return read_table_meta(filename)["columns"]
+
+def read_table (filename, columns=None, sds=True, mmap=True):
+  """ Load a table written by write_table() as
+  {"ids": [...], "columns": {name: array}, "sds": {name: array}, "sparse": bool}.
+
+  columns limits loading to the given columns, sds=False skips the
+  statistics. Number columns are memory-mapped unless mmap is off.
+  """
+  meta = read_table_meta(filename)
+  if columns is None:
+    columns = meta["columns"]
+  names = ["ids"] + ["col:" + c for c in columns] + ["txt:" + c for c in columns]
+  if sds:
+    names += ["sds:" + c for c in meta["sds"]]
+  arrays = load_arrays(filename, mmap, names)
+  output = {
+    "ids": decode_ids(arrays["ids"]),
+    "columns": {},
+    "sds": {},
+    "sparse": meta["sparse"],
+  }
+  for c in columns:
+    if "col:" + c in arrays:
+      output["columns"][c] = arrays["col:" + c]
+    elif "txt:" + c in arrays:
+      output["columns"][c] = [x or None for x in decode_ids(arrays["txt:" + c])]
+    else:
+      raise KeyError(c)
+  if sds:
+    for c in meta["sds"]:
+      output["sds"][c] = arrays["sds:" + c]
+  return output
+
+def sds_to_dict (stats):
+  """ [mean, sd, min, max] as a dict, all None if there was no data """
+  if np.isnan(stats[0]):
+    return {"mean": None, "sd": None, "min": None, "max": None}
+  return dict(zip(["mean", "sd", "min", "max"], stats.tolist()))
+
+def nest (output, path, value):
+  for key in path[:-1]:
+    output = output.setdefault(key, {})
+  output[path[-1]] = value
+
+def export_table (filename, json_filename=None):
+  """ Write a table out as nested JSON for inspection.
+
+  Column names are split into nested keys at "/"; statistics go under
+  "sds" like in the JSON files stages used to write.
+  """
+  table = read_table(filename, mmap=False)
+  output = {}
+  if table["sds"]:
+    output["sds"] = {}
+    for name, stats in table["sds"].items():
+      nest(output["sds"], name.split("/"), sds_to_dict(stats))
+  columns = {name: column if isinstance(column, list) else column.tolist() for name, column in table["columns"].items()}
+  for i, row_id in enumerate(table["ids"]):
+    row = {}
+    for name, column in columns.items():
+      value = column[i]
+      if value is not None and value != value:
+        if table["sparse"]:
+          continue
+        value = None
+      nest(row, name.split("/"), value)
+    output[row_id] = row
+  if json_filename is None:
+    json_filename = os.path.splitext(filename)[0] + ".json"
+  with open(json_filename, 'w') as f:
+    json.dump(output, f, indent=2, ensure_ascii=False)
+
+def intersect_tree (geoms, tree_geoms, tree):
+  """ Intersect each of geoms with the tree_geoms it overlaps.
+
+  Where one geometry lies wholly inside the other the overlay is skipped
+  and the inner geometry is returned as the intersection.
+  """
+  geom_idx, tree_idx = tree.query(geoms, predicate="intersects")
+  count("strtree_queries", len(geoms))
+  count("strtree_hits", len(geom_idx))
+  outer = geoms[geom_idx]
+  inner = tree_geoms[tree_idx]
+  shpl.prepare(outer)
+  shpl.prepare(inner)
+  intersections = np.empty(len(geom_idx), dtype=object)
+  contained = shpl.contains_properly(outer, inner)
+  intersections[contained] = inner[contained]
+  within = ~contained & shpl.contains_properly(inner, outer)
+  intersections[within] = outer[within]
+  partial = ~(contained | within)
+  intersections[partial] = shpl.intersection(inner[partial], outer[partial])
+  count("intersections", int(partial.sum()))
+  count("intersections_skipped", len(geom_idx) - int(partial.sum()))
+  return geom_idx, tree_idx, intersections
+
+def pop_pieces (first_geoms, pop_cells, pop_values, pop_tree):
+  """ Population grid cells cut by first geometries.
+
+  Returns (first_piece_idx, cell_idx, first_pieces, first_pop), with
+  first_pop the estimated population of each first geometry.
+  """
+  cell_area = shpl.area(pop_cells)
+  first_piece_idx, cell_idx, first_pieces = intersect_tree(first_geoms, pop_cells, pop_tree)
+  first_piece_pop = shpl.area(first_pieces) / cell_area[cell_idx] * pop_values[cell_idx]
+  first_pop = np.bincount(first_piece_idx, weights=first_piece_pop, minlength=len(first_geoms))
+  return first_piece_idx, cell_idx, first_pieces, first_pop
+
+_pop_piece_cache = {}
+
+def load_pop_pieces (path):
+  """ pop_pieces() of a shapefile, kept in memory per source version of
+  it and the population grid, so comparisons of one target map with
+  several others cut the grid only once """
+  stamp = (source_stamp(path), source_stamp(pop_path))
+  key = (path, pop_path)
+  if key not in _pop_piece_cache or _pop_piece_cache[key][0] != stamp:
+    geoms, columns = load_shapes(path, [])
+    pop_cells, pop_records = load_shapes(pop_path, ['POP'])
+    _pop_piece_cache[key] = (stamp, pop_pieces(geoms, pop_cells, pop_records['POP'].astype(float), load_tree(pop_path)))
+  return _pop_piece_cache[key][1]
+
+def pop_index (first_geoms, second_geoms, second_tree, pop_cells, pop_values, pop_tree, first_idx, second_idx, check=False, first_pieces=None):
+  """ Estimate population for first geometries and their overlaps with second geometries.
+
+  Population grid cells are overlaid with first geometries and the
+  resulting pieces with second geometries, so every cell × first × second
+  overlap is computed exactly once. first_pieces, if given, is the
+  pop_pieces() result for first_geoms. Returns (first_pop, int_pop),
+  where int_pop is aligned with the (first_idx, second_idx) pairs.
+  """
+  cell_area = shpl.area(pop_cells)
+
+  if first_pieces is None:
+    first_pieces = pop_pieces(first_geoms, pop_cells, pop_values, pop_tree)
+  first_piece_idx, cell_idx, first_pieces, first_pop = first_pieces
+
+  piece_idx, piece_second_idx, pieces = intersect_tree(first_pieces, second_geoms, second_tree)
+  piece_cell_idx = cell_idx[piece_idx]
+  piece_first_idx = first_piece_idx[piece_idx]
+  piece_pop = shpl.area(pieces) / cell_area[piece_cell_idx] * pop_values[piece_cell_idx]
+
+  pair_keys = first_idx * len(second_geoms) + second_idx
+  piece_keys = piece_first_idx * len(second_geoms) + piece_second_idx
+  order = np.argsort(pair_keys)
+  pair_pos = order[np.searchsorted(pair_keys, piece_keys, sorter=order).clip(max=len(order) - 1)] if len(order) else piece_keys
+  matched = pair_keys[pair_pos] == piece_keys if len(order) else np.zeros(len(piece_keys), dtype=bool)
+  int_pop = np.bincount(pair_pos[matched], weights=piece_pop[matched], minlength=len(pair_keys))
+
+  if check:
+    covered_pop = np.bincount(piece_first_idx, weights=piece_pop, minlength=len(first_geoms))
+    tolerance = 1e-6 * np.maximum(first_pop, 1)
+    assert np.all(int_pop <= covered_pop[first_idx] + tolerance[first_idx]), "Overlap population exceeds covered population"
+    assert np.all(covered_pop <= first_pop + tolerance), "Covered population exceeds district population"
+    assert first_pop.sum() <= pop_values.sum() * (1 + 1e-9), "District population exceeds grid population"
+    print("Population conservation: %.6f of first population covered by second shapes" % (covered_pop.sum() / first_pop.sum() if first_pop.sum() else 1))
+
+  return first_pop, int_pop
+
+def overlay_bulk (first_geoms, second_geoms, second_tree):
+  """ Intersect all first geometries with all second geometries at once.
+
+  Returns (first_idx, second_idx, area_fraction) for the non-empty
+  overlaps, truncated per first geometry the same way as the
+  loop in compare() does once the area fractions add up to 1.
+  """
+  first_idx, second_idx = second_tree.query(first_geoms, predicate="intersects")
+  count("strtree_queries", len(first_geoms))
+  count("strtree_hits", len(first_idx))
+  intersections = shpl.intersection(first_geoms[first_idx], second_geoms[second_idx])
+  count("intersections", len(first_idx))
+  first_area = shpl.area(first_geoms)[first_idx]
+  area_fraction = np.zeros(len(first_idx))
+  np.divide(shpl.area(intersections), first_area, out=area_fraction, where=first_area != 0)
+
+  keep = area_fraction != 0
+  nonzero = np.flatnonzero(keep)
+  for group in np.split(nonzero, np.flatnonzero(np.diff(first_idx[nonzero])) + 1):
+    full = np.flatnonzero(np.cumsum(area_fraction[group]) >= 1)
+    if len(full):
+      keep[group[full[0] + 1:]] = False
+
+  return first_idx[keep], second_idx[keep], area_fraction[keep]
+
+def compare_loop (first, second):
+  """ Reference implementation of compare() going one district at a time """
   first_shape = shpf.Reader(shape_paths[first])
   second_shape = shpf.Reader(shape_paths[second])
   
@@ -881,7 +1945,11 @@ def compare (first, second):
   
   def estimate_pop (geom):
     pop = 0
-    for i in pop_tree.query(geom):
+    hits = pop_tree.query(geom)
+    count("strtree_queries")
+    count("strtree_hits", len(hits))
+    count("intersections", len(hits))
+    for i in hits:
       sr = pop_records[i]
       sr_geom = pop_cells[i]
       intersection = sr_geom.intersection(geom)
@@ -901,11 +1969,15 @@ def compare (first, second):
     first_pop = estimate_pop(first_geom)
     output[first_id] = []
     
-    for i in second_tree.query(first_geom):
+    hits = second_tree.query(first_geom)
+    count("strtree_queries")
+    count("strtree_hits", len(hits))
+    for i in hits:
       sr2 = second_records[i]
       second_geom = second_geoms[i]
       second_id = sr_id(sr2, second)
       intersection = first_geom.intersection(second_geom)
+      count("intersections")
       area_fraction = intersection.area / first_area if first_area else 0
       if not area_fraction:
         continue
@@ -918,12 +1990,50 @@ def compare (first, second):
       })
       if sum_attr(output[first_id], "area_fraction") >= 1:
         break
-  
-  filename = get_compare_filename(first, second)
-  with open(filename, "w") as f:
-    json.dump(output, f, indent=2)
   return output
 
+def compare (first, second, bulk=True, check_pop=False, filename=None):
+  """ Overlay the first and second maps and write their crosswalk to
+  filename (compare_<first>_<second>.npz by default), see
+  load_crosswalk() """
+  if filename is None:
+    filename = get_crosswalk_filename(first, second)
+  if not bulk:
+    write_crosswalk(filename, *crosswalk_arrays(compare_loop(first, second)))
+  else:
+    first_geoms, first_records = load_shapes(shape_paths[first], id_fields[first])
+    second_geoms, second_records = load_shapes(shape_paths[second], id_fields[second])
+    pop_cells, pop_records = load_shapes(pop_path, ['POP'])
+    pop_values = pop_records['POP'].astype(float)
+    first_ids = record_ids(first_records, id_fields[first])
+    second_ids = record_ids(second_records, id_fields[second])
+    second_tree = load_tree(shape_paths[second])
+    pop_tree = load_tree(pop_path)
+
+    first_idx, second_idx, area_fraction = overlay_bulk(first_geoms, second_geoms, second_tree)
+    first_pop, int_pop = pop_index(
+      first_geoms, second_geoms, second_tree,
+      pop_cells, pop_values, pop_tree,
+      first_idx, second_idx, check=check_pop,
+      first_pieces=load_pop_pieces(shape_paths[first]),
+    )
+    first_pop = first_pop[first_idx]
+    pop_fraction = np.zeros(len(first_idx))
+    np.divide(int_pop, first_pop, out=pop_fraction, where=first_pop != 0)
+
+    rows = [[] for first_id in first_ids]
+    for k, i in enumerate(first_idx.tolist()):
+      rows[i].append(k)
+    last = {first_id: i for i, first_id in enumerate(first_ids)}
+    keep = [last[first_id] for first_id in dict.fromkeys(first_ids)]
+    order = np.array([k for i in keep for k in rows[i]], dtype=np.int64)
+    indptr = np.append(0, np.cumsum([len(rows[i]) for i in keep]))
+    ids, indices = index_ids([second_ids[j] for j in second_idx[order].tolist()])
+    write_crosswalk(
+      filename, [first_ids[i] for i in keep], ids,
+      indptr, indices, area_fraction[order], pop_fraction[order],
+    )
+
 def list_fields ():
   output = {}
   for e in elections.keys():
@@ -931,8 +2041,226 @@ def list_fields ():
     output[e] = [f[0] for f in sh.fields]
   return output
 
+fetch_workers = 8
+fetch_retries = 4
+fetch_backoff = 0.5 # seconds, doubled after every failed attempt
+fetch_rate = 20 # requests per second per host
+fetch_timeout = 30
+
+def get_http_cache_dir ():
+  return os.path.join(cache_dir, "http")
+
+def get_http_cache_filename (url):
+  return os.path.join(get_http_cache_dir(), "urls", "%s.json" % hashlib.sha256(url.encode()).hexdigest())
+
+def get_http_body_filename (digest):
+  return os.path.join(get_http_cache_dir(), "bodies", digest[:2], digest)
+
+def write_atomic (filename, data):
+  os.makedirs(os.path.dirname(filename), exist_ok=True)
+  tmp_filename = "%s.%d.%d.tmp" % (filename, os.getpid(), threading.get_ident())
+  with open(tmp_filename, "wb") as f:
+    f.write(data)
+  os.replace(tmp_filename, filename)
+
+def write_http_cache (url, headers, body):
+  """ Store a response body by content hash and point url at it """
+  digest = hashlib.sha256(body).hexdigest()
+  body_filename = get_http_body_filename(digest)
+  if not os.path.exists(body_filename):
+    write_atomic(body_filename, body)
+  meta = {
+    "url": url,
+    "body": digest,
+    "etag": headers.get("ETag"),
+    "last_modified": headers.get("Last-Modified"),
+  }
+  write_atomic(get_http_cache_filename(url), json.dumps(meta).encode())
+
+def read_http_cache (url):
+  """ Returns (meta, body) of a cached response or None """
+  try:
+    with open(get_http_cache_filename(url), "r") as f:
+      meta = json.load(f)
+    with open(get_http_body_filename(meta["body"]), "rb") as f:
+      body = f.read()
+  except (FileNotFoundError, ValueError, KeyError):
+    return None
+  if hashlib.sha256(body).hexdigest() != meta["body"]:
+    return None
+  return meta, body
+
+class Fetcher:
+  """ Fetches URLs from a pool of worker threads.
+
+  Every worker keeps its own keep-alive connection per host. Failed
+  requests are retried with exponential backoff, and requests to the
+  same host are spaced to stay under fetch_rate.
+
+  Responses are kept in a local cache and revalidated with conditional
+  requests. In offline mode everything is served from the cache and
+  the network is never touched.
+  """
+
+  def __init__ (self, workers=None, retries=None, backoff=None, rate=None, cache=True, offline=False):
+    """ Unset options default to the fetch_* settings at call time """
+    self.cache = cache or offline
+    self.offline = offline
+    self.retries = fetch_retries if retries is None else retries
+    self.backoff = fetch_backoff if backoff is None else backoff
+    rate = fetch_rate if rate is None else rate
+    self.interval = 1.0 / rate if rate else 0
+    self.pool = ThreadPoolExecutor(fetch_workers if workers is None else workers)
+    self.local = threading.local()
+    self.lock = threading.Lock()
+    self.next_slot = {}
+    self.request_count = 0
+    self.counters = trace_counters()
+
+  def __enter__ (self):
+    return self
+
+  def __exit__ (self, *args):
+    self.close()
+
+  def close (self):
+    self.pool.shutdown()
+
+  def connection (self, scheme, host):
+    if not hasattr(self.local, "connections"):
+      self.local.connections = {}
+    if (scheme, host) not in self.local.connections:
+      conn_class = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+      self.local.connections[(scheme, host)] = conn_class(host, timeout=fetch_timeout)
+    return self.local.connections[(scheme, host)]
+
+  def drop_connection (self, scheme, host):
+    conn = self.local.connections.pop((scheme, host), None)
+    if conn is not None:
+      conn.close()
+
+  def wait_turn (self, host):
+    with self.lock:
+      now = monotonic()
+      slot = max(now, self.next_slot.get(host, now))
+      self.next_slot[host] = slot + self.interval
+      self.request_count += 1
+    if slot > now:
+      sleep(slot - now)
+
+  def request (self, url, headers={}):
+    """ Single GET request, returns (status, headers, body) """
+    parts = urllib.parse.urlsplit(url)
+    path = parts.path + ("?" + parts.query if parts.query else "")
+    self.wait_turn(parts.netloc)
+    conn = self.connection(parts.scheme, parts.netloc)
+    count("http_requests", counters=self.counters)
+    start = perf_counter()
+    try:
+      conn.request("GET", path, headers=headers)
+      response = conn.getresponse()
+      body = response.read()
+    except (http.client.HTTPException, OSError):
+      self.drop_connection(parts.scheme, parts.netloc)
+      count("http_errors", counters=self.counters)
+      raise
+    count_latency("http_latency", perf_counter() - start, counters=self.counters)
+    count("http_bytes", len(body), counters=self.counters)
+    if response.will_close:
+      self.drop_connection(parts.scheme, parts.netloc)
+    return response.status, response.headers, body
+
+  def get (self, url, headers={}):
+    """ GET url with retries, following redirects, returns (status, headers, body) """
+    for attempt in range(self.retries + 1):
+      try:
+        status, response_headers, body = self.request(url, headers)
+      except (http.client.HTTPException, OSError) as e:
+        if attempt == self.retries:
+          raise
+      else:
+        if status in (301, 302, 303, 307, 308) and "Location" in response_headers:
+          url = urllib.parse.urljoin(url, response_headers["Location"])
+          continue
+        if status == 304:
+          return status, response_headers, body
+        if status < 500 and status != 429:
+          if status >= 400:
+            raise urllib.error.HTTPError(url, status, "HTTP Error %d" % status, response_headers, None)
+          return status, response_headers, body
+        if attempt == self.retries:
+          raise urllib.error.HTTPError(url, status, "HTTP Error %d" % status, response_headers, None)
+      sleep(self.backoff * 2**attempt)
+
+  def get_cached (self, url):
+    """ GET url through the response cache, returns the body """
+    if not self.cache:
+      return self.get(url)[2]
+    cached = read_http_cache(url)
+    if self.offline:
+      if cached is None:
+        raise urllib.error.URLError("%s is not cached" % url)
+      count("http_cache_hits", counters=self.counters)
+      return cached[1]
+    headers = {}
+    if cached is not None:
+      meta = cached[0]
+      if meta.get("etag"):
+        headers["If-None-Match"] = meta["etag"]
+      if meta.get("last_modified"):
+        headers["If-Modified-Since"] = meta["last_modified"]
+    status, response_headers, body = self.get(url, headers)
+    if status == 304 and cached is not None:
+      count("http_not_modified", counters=self.counters)
+      return cached[1]
+    write_http_cache(url, response_headers, body)
+    return body
+
+  def get_json (self, url):
+    return json.loads(self.get_cached(url).decode())
+
+  def get_json_or_none (self, url):
+    try:
+      return self.get_json(url)
+    except urllib.error.URLError as e:
+      print("FAIL: %s" % url)
+      return None
+
+  def iter_json (self, urls, ignore_errors=False):
+    """ Fetch and parse JSON URLs concurrently, yielding (index, data) as they complete.
+
+    A failed URL doesn't stop the others: every successful download is
+    yielded first and the first error is raised at the end.
+    """
+    func = self.get_json_or_none if ignore_errors else self.get_json
+    futures = {self.pool.submit(func, url): i for i, url in enumerate(urls)}
+    error = None
+    try:
+      for future in as_completed(futures):
+        try:
+          data = future.result()
+        except Exception as e:
+          print("FAIL: %s (%s)" % (urls[futures[future]], e))
+          if error is None:
+            error = e
+          continue
+        yield futures[future], data
+      if error is not None:
+        raise error
+    finally:
+      for future in futures:
+        future.cancel()
+
+  def map_json (self, urls, ignore_errors=False):
+    """ Fetch and parse a list of JSON URLs concurrently, keeping their order.
+
+    With ignore_errors, URLs that fail with an HTTP error yield None.
+    """
+    func = self.get_json_or_none if ignore_errors else self.get_json
+    return list(self.pool.map(func, urls))
+
 def get_result_base_url (election, suffix = None):
-  base = "https://www.vrk.lt/statiniai/puslapiai/rinkimai/%s" % urls[election]['dir']
+  base = vrk_url + urls[election]['dir']
   if suffix is not None:
     base += suffix
   return base
@@ -949,158 +2277,221 @@ def get_rpl_id_filename (election):
   return "rpl_id_map_%s.json" % election
 
 def get_result_filename (election):
-  return "results_%s.json" % election
-
-def get_results (election):
-  rpl_url = get_result_base_url(election, "rpl.json")
-  with urllib.request.urlopen(rpl_url) as url:
-    rpl_list = json.loads(url.read().decode())
-  rpg_url = get_result_base_url(election, "rpg.json")
-  with urllib.request.urlopen(rpg_url) as url:
-    rpg_list = json.loads(url.read().decode())
+  return "results_%s.npz" % election
+
+def get_checkpoint_filename (election):
+  return "results_%s.checkpoint.jsonl" % election
+
+def read_checkpoint (filename):
+  """ Returns ({rpl: votes}, {rpg: activity}) logged so far """
+  rpl_done = {}
+  rpg_done = {}
+  try:
+    with open(filename, 'r') as f:
+      for line in f:
+        try:
+          record = json.loads(line)
+        except ValueError:
+          # torn write from an interrupted run
+          continue
+        if "rpl" in record:
+          rpl_done[record["rpl"]] = record["votes"]
+        elif "rpg" in record:
+          rpg_done[record["rpg"]] = record["activity"]
+  except FileNotFoundError:
+    pass
+  return rpl_done, rpg_done
+
+def write_results (filename, output):
+  """ Write {district id: {key: value}} results as a sparse table """
+  names = list(dict.fromkeys(k for result in output.values() for k in result))
+  columns = {name: [float(result[name]) if name in result else np.nan for result in output.values()] for name in names}
+  write_table(filename, list(output), columns, sparse=True)
+
+def get_results (election, fetcher=None, offline=False):
+  """ Download election results of every polling district.
+
+  Every downloaded district and constituency activity file is appended
+  to a checkpoint log as soon as it arrives, so an interrupted download
+  resumes with only the missing items. The log is compacted into the
+  results file at the end.
+  """
+  if fetcher is None:
+    with Fetcher(offline=offline) as fetcher:
+      return get_results(election, fetcher)
+
+  rpl_list, rpg_list = fetcher.map_json([
+    get_result_base_url(election, "rpl.json"),
+    get_result_base_url(election, "rpg.json"),
+  ])
   map_file = get_rpl_id_filename(election)
   out_file = get_result_filename(election)
+  checkpoint_file = get_checkpoint_filename(election)
   rpg_nr_map = {x['id']: x['nr'] for x in rpg_list['data']}
-  rpl_id_map = {}
-  output = {}
-  output[TOTAL] = {}
-  try:
-    with open(out_file, 'r') as f:
-      old_output = json.load(f)
-  except FileNotFoundError:
-    old_output = None
-  old_output = None
+  rpl_done, rpg_done = read_checkpoint(checkpoint_file)
 
-  if old_output is None or TOTAL not in old_output:
-    for rpl in rpl_list['data']:
-      rpg_nr = rpg_nr_map[rpl['rpg_id']]
-      rpl_id = "%s:%s:%s" % (rpg_nr, rpl['nr'], pav_to_slug(rpl['pav']))
-      rpl_id_map[rpl_id] = rpl['id']
-      with urllib.request.urlopen(get_result_rpl_url(election, rpl['id'])) as url:
-        result = json.loads(url.read().decode())
-      output[rpl_id] = {}
-      for item in result['data']['balsai'][0:-1]:
-        name = name_map[election][item['partija']] if item['partija'] in name_map[election] else item['partija']
-        output[rpl_id][name] = item['proc_nuo_gal_biul']
-        if name not in output[TOTAL]:
-          output[TOTAL][name] = item['proc_nuo_gal_biul_lt']
-    with open(map_file, 'w') as f:
-      json.dump(rpl_id_map, f, indent=2, ensure_ascii=False)
-    
-    with open(out_file, 'w') as f:
-      json.dump(output, f, indent=2, ensure_ascii=False)
-  else:
-    with open(map_file, 'r') as f:
-      rpl_id_map = json.load(f)
-    output = old_output
-
-  if TURNOUT not in output[TOTAL]:
-    rpl_id_reverse_map = {v: k for k, v in rpl_id_map.items()}
-    total_voters = 0
-    total_turnout = 0
+  with open(checkpoint_file, 'a') as log:
+    def append (record):
+      log.write(json.dumps(record, ensure_ascii=False) + "\n")
+      log.flush()
+
+    missing = [rpl['id'] for rpl in rpl_list['data'] if rpl['id'] not in rpl_done]
+    for i, result in fetcher.iter_json([get_result_rpl_url(election, rpl_id) for rpl_id in missing]):
+      votes = [[item['partija'], item['proc_nuo_gal_biul'], item['proc_nuo_gal_biul_lt']] for item in result['data']['balsai'][0:-1]]
+      rpl_done[missing[i]] = votes
+      append({"rpl": missing[i], "votes": votes})
+
+    # one activity file covers every rpl of its rpg
+    rpg_ids = []
     for rpl in rpl_list['data']:
-      rpg_nr = rpg_nr_map[rpl['rpg_id']]
-      rpl_id = "%s:%s:%s" % (rpg_nr, rpl['nr'], pav_to_slug(rpl['pav']))
-      if TURNOUT in output[rpl_id]:
-        continue
-      try:
-        with urllib.request.urlopen(get_activity_rpg_url(election, rpl['rpg_id'])) as url:
-          activity = json.loads(url.read().decode())
-      except urllib.error.HTTPError as e:
-        print("FAIL: %s" % get_activity_rpg_url(election, rpl['rpg_id']))
+      if rpl['rpg_id'] not in rpg_ids:
+        rpg_ids.append(rpl['rpg_id'])
+    missing = [rpg_id for rpg_id in rpg_ids if rpg_id not in rpg_done]
+    for i, activity in fetcher.iter_json([get_activity_rpg_url(election, rpg_id) for rpg_id in missing], ignore_errors=True):
+      if activity is None:
         continue
-      for item in activity['data'][0:-1]:
-        sub_rpl_id = rpl_id_reverse_map[item['rpl_id']]
-        output[sub_rpl_id][TURNOUT] = item['val_viso']
-        output[sub_rpl_id][VOTERS] = item['rinkeju_skaicius']
-        total_voters += int(output[sub_rpl_id][VOTERS])
-        total_turnout += int(output[sub_rpl_id][VOTERS]) * float(output[sub_rpl_id][TURNOUT]) / 100.0
-    output[TOTAL][VOTERS] = total_voters
-    output[TOTAL][TURNOUT] = round(100 * total_turnout / total_voters, 2)
+      items = [[item['rpl_id'], item['val_viso'], item['rinkeju_skaicius']] for item in activity['data'][0:-1]]
+      rpg_done[missing[i]] = items
+      append({"rpg": missing[i], "activity": items})
+
+  # fail before writing any output, so that the stage isn't taken as
+  # built and the next run retries the missing files from the checkpoint
+  failed = [rpg_id for rpg_id in rpg_ids if rpg_id not in rpg_done]
+  if failed:
+    raise RuntimeError("%d activity files of %s failed to download, rerun to retry: %s" % (len(failed), election, ", ".join(str(rpg_id) for rpg_id in failed)))
+
+  rpl_id_map = {}
+  output = {}
+  output[TOTAL] = {}
+  for rpl in rpl_list['data']:
+    rpg_nr = rpg_nr_map[rpl['rpg_id']]
+    rpl_id = "%s:%s:%s" % (rpg_nr, rpl['nr'], pav_to_slug(rpl['pav']))
+    rpl_id_map[rpl_id] = rpl['id']
+    output[rpl_id] = {}
+    for party, vote, total_vote in rpl_done[rpl['id']]:
+      name = name_map[election][party] if party in name_map[election] else party
+      output[rpl_id][name] = vote
+      if name not in output[TOTAL]:
+        output[TOTAL][name] = total_vote
+
+  rpl_id_reverse_map = {v: k for k, v in rpl_id_map.items()}
+  total_voters = 0
+  total_turnout = 0
+  for rpg_id in rpg_ids:
+    for rpl_id, turnout, voters in rpg_done[rpg_id]:
+      sub_rpl_id = rpl_id_reverse_map[rpl_id]
+      output[sub_rpl_id][TURNOUT] = turnout
+      output[sub_rpl_id][VOTERS] = voters
+      total_voters += int(voters)
+      total_turnout += int(voters) * float(turnout) / 100.0
+  output[TOTAL][VOTERS] = total_voters
+  output[TOTAL][TURNOUT] = round(100 * total_turnout / total_voters, 2)
 
   with open(map_file, 'w') as f:
     json.dump(rpl_id_map, f, indent=2, ensure_ascii=False)
   
-  with open(out_file, 'w') as f:
-    json.dump(output, f, indent=2, ensure_ascii=False)
+  write_results(out_file, output)
+
+  os.remove(checkpoint_file)
   return output
 
 def get_popularity_filename (first, second):
-  return "popularity_%s_for_%s.json" % (second, first)
+  return "popularity_%s_for_%s.npz" % (second, first)
+
+def crosswalk_weights (crosswalk, turnout):
+  """ Sparse matrix W (first × second districts) of pop_fraction × turnout
+  weights, each row normalized to add up to 1 """
+  shape = (len(crosswalk["first_ids"]), len(crosswalk["second_ids"]))
+  W = sps.csr_matrix((crosswalk["pop_fraction"] * turnout[crosswalk["indices"]], crosswalk["indices"], crosswalk["indptr"]), shape=shape)
+  denom = W @ np.ones(shape[1])
+  rows = np.repeat(np.arange(shape[0]), np.diff(crosswalk["indptr"]))
+  W.data = W.data / denom[rows]
+  return W
+
+def results_matrix (results, ids, columns):
+  """ Dense matrix R (ids × columns) of result values, NaN where missing.
+
+  results is a results table, columns maps each column to the list of
+  result keys added up in it.
+  """
+  pos = {rid: i for i, rid in enumerate(results["ids"])}
+  rows = np.array([pos[rid] for rid in ids], dtype=np.int64)
+  R = np.full((len(ids), len(columns)), np.nan)
+  for c, aliases in enumerate(columns.values()):
+    total = np.zeros(len(ids))
+    present = np.zeros(len(ids), dtype=bool)
+    for alias in aliases:
+      if alias not in results["columns"]:
+        continue
+      vote = results["columns"][alias][rows]
+      total += np.where(np.isnan(vote), 0, vote)
+      present |= ~np.isnan(vote)
+    R[present, c] = total[present]
+  return R
+
+def project_results (W, R):
+  """ W·R ignoring missing values. Cells with no result among the
+  overlapping districts come out as NaN. """
+  present = ~np.isnan(R)
+  pattern = sps.csr_matrix((np.ones(len(W.data)), W.indices, W.indptr), shape=W.shape)
+  output = W @ np.where(present, R, 0)
+  output[(pattern @ present.astype(float)) == 0] = np.nan
+  return output
 
-def results_to_popularity (first, second):
-  with open(get_compare_filename(first, second), 'r') as f:
-    compare_data = json.load(f)
-  with open(get_result_filename(second), 'r') as f:
-    result_data = json.load(f)
-  
-  output = {'sds':{}}
-  party_votes = {}
-  for first_id, items in compare_data.items():
-    if not items:
-      continue
-    weight_denom = sum([i["pop_fraction"] * float(result_data[i['id']][TURNOUT]) for i in items])
-    apl_out = {}
-    for party, alias_list in {**party_alias, **{TURNOUT: {}, VOTERS: {}}}.items():
-      if second in alias_list:
-        aliases = alias_list[second]
-      else:
-        aliases = [party]
-      for item in items:
-        result = result_data[item['id']]
-        weight = (item['pop_fraction'] * float(result[TURNOUT])) / weight_denom
-        vote_list = [float(result[alias]) for alias in aliases if alias in result]
-        raw_vote = sum(vote_list) if vote_list else None
-        if party not in apl_out:
-          apl_out[party] = {
-            "value": None,
-            "bias": None,
-            "bias_sd": None,
-          }
-        if raw_vote is not None:
-          if apl_out[party]["value"] is None:
-            apl_out[party]["value"] = 0
-          apl_out[party]["value"] += raw_vote * weight
-      if party not in party_votes:
-        party_votes[party] = []
-      if apl_out[party]["value"] is not None:
-        party_votes[party].append(float(apl_out[party]["value"]))
-    output[first_id] = apl_out
-  
-  party_sds = {}
-  for party, votes in party_votes.items():
-    if not votes:
-      party_sds[party] = {
+def column_stats (P):
+  """ mean, sd, min and max of each column of P, skipping NaN """
+  output = []
+  for c in range(P.shape[1]):
+    col = P[:, c][~np.isnan(P[:, c])]
+    if not len(col):
+      output.append({
         "mean": None,
         "sd": None,
         "min": None,
         "max": None,
-      }
-      continue
-    df = pd.DataFrame(votes)
-    mean = float(df.mean().iloc[0])
-    sd = float(df.std().iloc[0])
-    party_sds[party] = {
-      "mean": mean,
-      "sd": sd,
-      "min": min(votes),
-      "max": max(votes),
-    }
-  output['sds'] = party_sds
-    
-  for first_id in compare_data.keys():
-    if first_id not in output:
+      })
       continue
-    apl_out = output[first_id]
-    for party, sds in party_sds.items():
-      if apl_out[party]["value"] is None:
-        continue
-      output[first_id][party]["bias"] = float(apl_out[party]["value"]) - sds["mean"]
-      output[first_id][party]["bias_sd"] = (output[first_id][party]["bias"] / sds["sd"]) if sds["sd"] > 0 else 0
-    
-  filename = get_popularity_filename(first, second)
-  with open(filename, 'w') as f:
-    json.dump(output, f, indent=2, ensure_ascii=False)
+    output.append({
+      "mean": float(np.mean(col)),
+      "sd": float(np.std(col, ddof=1)) if len(col) > 1 else float("nan"),
+      "min": float(np.min(col)),
+      "max": float(np.max(col)),
+    })
+  return output
+
+def results_to_popularity (first, second):
+  """ Project election results onto first districts.
+
+  Popularity of every party in every first district is the product of
+  the crosswalk weights W and the results R of the second districts.
+  """
+  crosswalk = load_crosswalk(first, second)
+  results = read_table(get_result_filename(second), sds=False)
+
+  columns = {}
+  for party, aliases in {**election_party_alias(second), TURNOUT: None, VOTERS: None}.items():
+    columns[party] = aliases if aliases is not None else [party]
+  R = results_matrix(results, crosswalk["second_ids"], columns)
+  turnout = R[:, list(columns).index(TURNOUT)]
+  W = crosswalk_weights(crosswalk, turnout)
+  rows = np.flatnonzero(np.diff(crosswalk["indptr"]))
+  P = project_results(W, R)[rows]
+
+  party_sds = dict(zip(columns, column_stats(P)))
+  means = np.array([np.nan if x["mean"] is None else x["mean"] for x in party_sds.values()])
+  sds = np.array([np.nan if x["sd"] is None else x["sd"] for x in party_sds.values()])
+  bias = P - means
+  with np.errstate(invalid='ignore', divide='ignore'):
+    bias_sd = np.where(sds > 0, bias / sds, 0.0)
+
+  table = {}
+  for c, party in enumerate(columns):
+    table["%s/value" % party] = P[:, c]
+    table["%s/bias" % party] = np.where(np.isnan(P[:, c]), np.nan, bias[:, c])
+    table["%s/bias_sd" % party] = np.where(np.isnan(P[:, c]), np.nan, bias_sd[:, c])
+  sds = {party: [x["mean"], x["sd"], x["min"], x["max"]] for party, x in party_sds.items()}
+  ids = [crosswalk["first_ids"][i] for i in rows]
+  write_table(get_popularity_filename(first, second), ids, table, sds)
 
 def mean (_list):
   return sum(_list) / len(_list)
@@ -1112,123 +2503,83 @@ def round_floats (o, precision=4):
   return o
 
 def combine (first, election_list, out_file):
-  output = {}
-  
-  for second in election_list:
-    votes_file = get_popularity_filename(first, second)
-    values_file = get_values_filename(first, second)
-    with open(votes_file, 'r') as f:
-      votes_data = json.load(f)
-    for apl_id, party_results in votes_data.items():
-      
-      if apl_id not in output:
-        output[apl_id] = {}
-      if 'votes' not in output[apl_id]:
-        output[apl_id]['votes'] = {}
-      for party, results in party_results.items():
-        if party not in output[apl_id]['votes']:
-          output[apl_id]['votes'][party] = {}
-        output[apl_id]['votes'][party][second] = results
-
-    with open(values_file, 'r') as f:
-      values_data = json.load(f)
-    for apl_id, value_results in values_data.items():
-      if 'values' not in output[apl_id]:
-        output[apl_id]['values'] = {}
-      for key, value in value_results.items():
-        if key not in output[apl_id]['values']:
-          output[apl_id]['values'][key] = {}
-        output[apl_id]['values'][key][second] = value
-
-  value_lists = {}
+  """ Merge popularity and values of all elections for first and add a
+  summary weighted by election date and turnout.
+
+  Summaries are computed on arrays of districts × keys × elections, NaN
+  standing in for missing values.
+  """
+  categories = {
+    "votes": get_popularity_filename,
+    "values": get_values_filename,
+  }
+  tables = {category: [read_table(get_filename(first, second), mmap=False) for second in election_list] for category, get_filename in categories.items()}
 
-  first_date = election_dates[first]
-  date_weights = [2**((election_dates[e] - first_date) / DATE_HALFLIFE) for e in election_list]
+  apl_ids = list(dict.fromkeys(apl_id for table in tables["votes"] for apl_id in table["ids"]))
+  apl_pos = {apl_id: i for i, apl_id in enumerate(apl_ids)}
+  fields = ["value", "bias", "bias_sd"]
 
-  for apl_id, data in output.items():
-    if apl_id == 'sds':
-      continue
-    
-    turnout_weights = [data["votes"]["TURNOUT"][e]["value"] / 100 for e in election_list]
-    raw_weights = {e: date_weights[i]*turnout_weights[i] for i, e in enumerate(election_list)}
-    
-    for category, category_data in data.items():
-      if category not in value_lists:
-        value_lists[category] = {}
-      for key, election_data in category_data.items():
-        if key not in value_lists[category]:
-          value_lists[category][key] = []
-        item_keys = tuple(election_data.values())[0].keys()
-        output[apl_id][category][key]['summary'] = {}
-        for k in item_keys:
-          weights = []
-          data_list = []
-          for e in election_list:
-            v = election_data[e][k]
-            if v is None:
-              continue
-            weight = raw_weights[e]
-            weights.append(weight)
-            data_list.append(v * weight)
-          if not data_list:
-            out_val = None
-          else:
-            out_val = sum(data_list) / sum(weights)
-          output[apl_id][category][key]['summary'][k] = out_val
-        if output[apl_id][category][key]["summary"]["value"] is not None:
-          value_lists[category][key].append(output[apl_id][category][key]["summary"]["value"])
-
-  for category, category_data in value_lists.items():
-    for key, data_list in category_data.items():
-      if not data_list:
-        output["sds"][category][key]["summary"] = {
-          "mean": None,
-          "sd": None,
-          "min": None,
-          "max": None,
-        }
-        continue
-      df = pd.DataFrame(data_list)
-      avg = float(df.mean().iloc[0])
-      sd = float(df.std().iloc[0])
-      output["sds"][category][key]["summary"] = {
-        "mean": avg,
-        "sd": sd,
-        "min": min(data_list),
-        "max": max(data_list),
-      }
-
-  for apl_id, data in output.items():
-    if apl_id == "sds":
-      continue
-    for category, category_data in data.items():
-      max_bias = None
-      max_bias_key = None
-      min_bias = None
-      min_bias_key = None
-      for key, election_data in category_data.items():
-        if election_data["summary"]["value"] is None:
-          continue
-        output[apl_id][category][key]["summary"]["bias"] = election_data["summary"]["value"] - output["sds"][category][key]["summary"]["mean"]
-        output[apl_id][category][key]["summary"]["bias_sd"] = output[apl_id][category][key]["summary"]["bias"] / output["sds"][category][key]["summary"]["sd"]
-        if key in (TURNOUT, VOTERS):
+  first_date = election_dates[first]
+  date_weights = np.array([2**((election_dates[e] - first_date) / DATE_HALFLIFE) for e in election_list])
+  turnout = np.full((len(apl_ids), len(election_list)), np.nan)
+  for e, table in enumerate(tables["votes"]):
+    turnout[[apl_pos[apl_id] for apl_id in table["ids"]], e] = table["columns"]["%s/value" % TURNOUT]
+  weights = date_weights * (turnout / 100)
+
+  columns = {}
+  sds = {}
+  for category, election_tables in tables.items():
+    keys = list(dict.fromkeys(name.rsplit("/", 1)[0] for table in election_tables for name in table["columns"]))
+    A = np.full((len(fields), len(apl_ids), len(keys), len(election_list)), np.nan)
+    key_in = np.zeros((len(apl_ids), len(keys), len(election_list)), dtype=bool)
+    for e, table in enumerate(election_tables):
+      rows = [apl_pos[apl_id] for apl_id in table["ids"]]
+      for k, key in enumerate(keys):
+        if "%s/value" % key not in table["columns"]:
           continue
-        _bias = output[apl_id][category][key]["summary"]["bias_sd"]
-        if category == "values":
-          _bias = abs(_bias)
-        if max_bias is None or _bias > max_bias:
-          max_bias = _bias
-          max_bias_key = key
-        if min_bias is None or _bias < min_bias:
-          min_bias = _bias
-          min_bias_key = key
-      output[apl_id][category]["summary"] = {
-        "max_bias_key": max_bias_key,
-        "min_bias_key": min_bias_key,
-      }
-
-  with open(out_file, 'w') as f:
-    json.dump(round_floats(output), f, indent=2, ensure_ascii=False)
+        for f, field in enumerate(fields):
+          A[f, rows, k, e] = table["columns"]["%s/%s" % (key, field)]
+        key_in[rows, k, e] = True
+    if any(table["sparse"] for table in election_tables):
+      key_in &= ~np.isnan(A[0])
+    has_key = key_in.any(axis=2)
+
+    present = ~np.isnan(A[0])
+    num = np.zeros(A.shape[:3])
+    den = np.zeros(present.shape[:2])
+    for e in range(len(election_list)):
+      num += np.where(present[:, :, e], A[:, :, :, e] * weights[:, None, e], 0)
+      den += np.where(present[:, :, e], weights[:, None, e], 0)
+    any_present = present.any(axis=2)
+    with np.errstate(invalid='ignore', divide='ignore'):
+      summary = np.where(any_present, num / den, np.nan)
+
+    key_sds = column_stats(np.where(has_key, summary[0], np.nan))
+    means = np.array([np.nan if x["mean"] is None else x["mean"] for x in key_sds])
+    key_sd = np.array([np.nan if x["sd"] is None else x["sd"] for x in key_sds])
+    summary[1] = summary[0] - means
+    with np.errstate(invalid='ignore', divide='ignore'):
+      summary[2] = summary[1] / key_sd
+
+    candidates = any_present & has_key & ~np.isin(keys, [TURNOUT, VOTERS])
+    score = np.abs(summary[2]) if category == "values" else summary[2]
+    max_bias = np.argmax(np.where(candidates, score, -np.inf), axis=1)
+    min_bias = np.argmin(np.where(candidates, score, np.inf), axis=1)
+    has_candidates = candidates.any(axis=1)
+
+    for e, table in zip(election_list, election_tables):
+      for key, stats in table["sds"].items():
+        sds["%s/%s/%s" % (category, key, e)] = round_floats(stats.tolist())
+    for k, key in enumerate(keys):
+      sds["%s/%s/summary" % (category, key)] = round_floats([key_sds[k][s] for s in ["mean", "sd", "min", "max"]])
+      for e, election in enumerate(election_list + ["summary"]):
+        for f, field in enumerate(fields):
+          column = A[f, :, k, e] if election != "summary" else summary[f, :, k]
+          columns["%s/%s/%s/%s" % (category, key, election, field)] = round_floats(np.where(key_in[:, k, e] if election != "summary" else has_key[:, k], column, np.nan).tolist())
+    columns["%s/summary/max_bias_key" % category] = [keys[k] if c else None for k, c in zip(max_bias.tolist(), has_candidates)]
+    columns["%s/summary/min_bias_key" % category] = [keys[k] if c else None for k, c in zip(min_bias.tolist(), has_candidates)]
+
+  write_table(out_file, apl_ids, columns, sds)
 
 def linear_map (x, in_min, in_max, out_min, out_max):
   return (x - in_max) / (in_min - in_max) * (out_min - out_max) + out_max
@@ -1236,17 +2587,34 @@ def linear_map (x, in_min, in_max, out_min, out_max):
 def election_year (election):
   return int(election.split('_')[0])
 
-def get_party_value (party_values, election, party, value):
-  alias = None
+def election_party_alias (election):
+  """ Every base party of party_alias with its aliases in election, None
+  where it has none there """
+  return {base: alias_list.get(election) for base, alias_list in party_alias.items()}
+
+def election_party_values (party_values, election):
+  """ Entries of party_values for the parties in the results of election,
+  by party """
+  output = {}
+  for party in table_columns(get_result_filename(election)):
+    alias = resolve_party_value_alias(party_values, election, party)
+    if party not in [TURNOUT, VOTERS] and alias is not None:
+      output[party] = party_values[alias]
+  return output
+
+def resolve_party_value_alias (party_values, election, party):
+  """ Key of party_values holding the values of party in election, or None """
   if party in party_values:
-    alias = party
-  else:
-    for base, alias_list in party_alias.items():
-      if base not in party_values:
-        continue
-      if election in alias_list and party in alias_list[election]:
-        alias = base
-        break
+    return party
+  for base, alias_list in party_alias.items():
+    if base not in party_values:
+      continue
+    if election in alias_list and party in alias_list[election]:
+      return base
+  return None
+
+def get_party_value (party_values, election, party, value):
+  alias = resolve_party_value_alias(party_values, election, party)
   if alias is None:
     return None
   
@@ -1266,74 +2634,82 @@ def get_party_value (party_values, election, party, value):
     max_value = values[max_year][value]
     return linear_map(year, min_year, max_year, min_value, max_value)
 
-def get_values_filename (first, second):
-  return "values_%s_for_%s.json" % (second, first)
+def party_value_table (party_values, election, parties, value_keys):
+  """ Matrix (parties × value_keys) of party values in election.
 
-def results_to_values (first, second, party_values):
-  with open(get_compare_filename(first, second), 'r') as f:
-    compare_data = json.load(f)
-  with open(get_result_filename(second), 'r') as f:
-    result_data = json.load(f)
-  
-  output = {'sds':{}}
-  value_lists = {}
-  for first_id, items in compare_data.items():
-    if not items:
+  Values are looked up and interpolated between surveyed years once per
+  party. Parties without values and dimensions missing from a survey are
+  NaN.
+  """
+  year = election_year(election)
+  table = np.full((len(parties), len(value_keys)), np.nan)
+  for p, party in enumerate(parties):
+    alias = resolve_party_value_alias(party_values, election, party)
+    if alias is None:
       continue
-    total_result = result_data['TOTAL']
-    total_vote_sum = sum([float(v) for k, v in total_result.items() if k not in [TURNOUT, VOTERS]])
-    weight_denom = sum([i["pop_fraction"] * float(result_data[i['id']][TURNOUT]) for i in items])
-    apl_out = {}
-    
-    for value_key in values:
-      for item in items:
-        result = result_data[item['id']]
-        weight = (item['pop_fraction'] * float(result[TURNOUT])) / weight_denom
-        temp_list = []
-        for party, vote in result.items():
-          if party in [TURNOUT, VOTERS]:
-            continue
-          value = get_party_value(party_values, second, party, value_key)
-          if value is None:
-            continue
-          if value_key not in value_lists:
-            value_lists[value_key] = []
-          if value_key not in apl_out:
-            apl_out[value_key] = {
-              "value": 0,
-              "bias": 0,
-              "bias_sd": 0,
-            }
-          temp_list.append([value, weight, float(vote)])
-        vote_sum = sum_attr(temp_list, 2)
-        apl_out[value_key]['value'] += sum([val * weight * (vote / vote_sum) for val, weight, vote in temp_list])
-      value_lists[value_key].append(apl_out[value_key]["value"])
-    output[first_id] = apl_out   
-  
-  value_sds = {}
-  for value_key, value_list in value_lists.items():
-    df = pd.DataFrame(value_list)
-    mean = float(df.mean().iloc[0])
-    sd = float(df.std().iloc[0])
-    value_sds[value_key] = {
-      "mean": mean,
-      "sd": sd,
-      "min": min(value_list),
-      "max": max(value_list),
-    }
-  output['sds'] = value_sds
-  
-  for first_id in compare_data.keys():
-    if first_id not in output:
+    values = party_values[alias]
+    avail_years = [y for y in values.keys() if isinstance(y, int)]
+    if not avail_years:
       continue
-    apl_out = output[first_id]
-    for value_key, sds in value_sds.items():
-      output[first_id][value_key]["bias"] = float(apl_out[value_key]["value"]) - sds["mean"]
-      output[first_id][value_key]["bias_sd"] = (float(apl_out[value_key]["value"]) - sds["mean"]) / sds["sd"]
-    
-  filename = get_values_filename(first, second)
-  with open(filename, 'w') as f:
-    json.dump(output, f, indent=2, ensure_ascii=False)
+    for v, value in enumerate(value_keys):
+      if year in values:
+        table[p, v] = values[year].get(value, np.nan)
+      elif year < min(avail_years):
+        table[p, v] = values[min(avail_years)].get(value, np.nan)
+      elif year > max(avail_years):
+        table[p, v] = values[max(avail_years)].get(value, np.nan)
+      else:
+        min_year = max([y for y in avail_years if y < year])
+        max_year = min([y for y in avail_years if y > year])
+        min_value = values[min_year].get(value, np.nan)
+        max_value = values[max_year].get(value, np.nan)
+        table[p, v] = linear_map(year, min_year, max_year, min_value, max_value)
+  return table
+
+def get_values_filename (first, second):
+  return "values_%s_for_%s.npz" % (second, first)
+
+def results_to_values (first, second, party_values):
+  """ Project value dimensions (see values) onto first districts.
+
+  Each second district gets the vote-weighted mean value of the parties
+  that have one, and first districts the crosswalk-weighted mean of
+  those, for all dimensions at once.
+  """
+  crosswalk = load_crosswalk(first, second)
+  results = read_table(get_result_filename(second), sds=False)
+
+  parties = {party: [party] for party in results["columns"] if party not in [TURNOUT, VOTERS]}
+  turnout = results_matrix(results, crosswalk["second_ids"], {TURNOUT: [TURNOUT]})[:, 0]
+  R = results_matrix(results, crosswalk["second_ids"], parties)
+  V = party_value_table(party_values, second, list(parties), values)
+  valued = ~np.isnan(V)
+  votes = np.where(np.isnan(R), 0, R)
+
+  with np.errstate(invalid='ignore', divide='ignore'):
+    S = (votes @ np.where(valued, V, 0)) / (votes @ valued)
+  S[(~np.isnan(R)).astype(float) @ valued == 0] = np.nan
+  W = crosswalk_weights(crosswalk, turnout)
+  rows = np.flatnonzero(np.diff(crosswalk["indptr"]))
+  P = project_results(W, S)[rows]
+
+  value_keys = [v for c, v in enumerate(values) if not np.isnan(P[:, c]).all()]
+  P = P[:, [values.index(v) for v in value_keys]]
+  value_sds = dict(zip(value_keys, column_stats(P)))
+  means = np.array([x["mean"] for x in value_sds.values()])
+  sds = np.array([x["sd"] for x in value_sds.values()])
+  bias = P - means
+  with np.errstate(invalid='ignore', divide='ignore'):
+    bias_sd = bias / sds
+
+  table = {}
+  for c, value_key in enumerate(value_keys):
+    table["%s/value" % value_key] = P[:, c]
+    table["%s/bias" % value_key] = np.where(np.isnan(P[:, c]), np.nan, bias[:, c])
+    table["%s/bias_sd" % value_key] = np.where(np.isnan(P[:, c]), np.nan, bias_sd[:, c])
+  sds = {value_key: [x["mean"], x["sd"], x["min"], x["max"]] for value_key, x in value_sds.items()}
+  ids = [crosswalk["first_ids"][i] for i in rows]
+  write_table(get_values_filename(first, second), ids, table, sds, sparse=True)
 
 def get_geojson_filename (election):
   return "%s.geojson" % election
@@ -1348,65 +2724,445 @@ def shape_to_geojson (election):
   
   sf.to_file(output_filename, index=True)
 
-def compact_combine (combine_file, csv_file):
-  with open(combine_file, 'r') as f:
-    combine = json.load(f)
-
-  csv_output = []
+def csv_schema (combine_file):
+  """ Value columns of a combined table and their CSV header """
+  value_columns = [name for name in table_columns(combine_file) if name.endswith("/value")]
   csv_header = ["apl"]
-
-  for category, category_data in combine["sds"].items():
-    for key, election_data in category_data.items():
-      for election, values in election_data.items():
-        for value_key, value in values.items():
-          if value_key not in combine:
-            combine[value_key] = {}
-          if category not in combine[value_key]:
-            combine[value_key][category] = {}
-          if key not in combine[value_key][category]:
-            combine[value_key][category][key] = {}
-          if election not in combine[value_key][category][key]:
-            combine[value_key][category][key][election] = {}
-          combine[value_key][category][key][election]["value"] = value
-  del combine["sds"]
-
-  first = True
-  for apl_id, data in combine.items():
-    csv_row = []
-    csv_row.append(apl_id)
-    for category, category_data in data.items():
-      for key, election_data in category_data.items():
-        if key == "summary":
-          continue
-        for election, values in election_data.items():
-          header_key = "%s|%s" % (key, election)
-          if header_key not in csv_header:
-            csv_header.append(header_key)
-          value = round(values["value"], 2) if values["value"] is not None else None
-          csv_row.append(value)
-    csv_output.append(csv_row)
+  for name in value_columns:
+    category, key, election, field = name.split("/")
+    csv_header.append("%s|%s" % (key, election))
+  return value_columns, csv_header
+
+def compact_combine (combine_file, csv_file, chunk_rows=1000):
+  """ Write the values of a combined table as CSV, one row per district
+  followed by mean, sd, min and max rows.
+
+  Columns are memory-mapped and written chunk_rows districts at a time,
+  so memory use doesn't grow with the number of districts.
+  """
+  value_columns, csv_header = csv_schema(combine_file)
+  combine = read_table(combine_file, value_columns)
+  apl_ids = combine["ids"]
+  columns = [combine["columns"][name] for name in value_columns]
 
   with open(csv_file, 'w', newline='') as f:
     writer = csv.writer(f, quoting=csv.QUOTE_MINIMAL, dialect='unix')
     writer.writerow(csv_header)
-    writer.writerows(csv_output)
+    for start in range(0, len(apl_ids), chunk_rows):
+      block = zip(*[column[start:start + chunk_rows].tolist() for column in columns])
+      writer.writerows([apl_id] + [round(x, 2) if x == x else None for x in row] for apl_id, row in zip(apl_ids[start:start + chunk_rows], block))
+    sds = [sds_to_dict(combine["sds"][name.rsplit("/", 1)[0]]) for name in value_columns]
+    for stat in ["mean", "sd", "min", "max"]:
+      writer.writerow([stat] + [round(x[stat], 2) if x[stat] is not None else None for x in sds])
+
+BIN_MAGIC = b"RNK1"
+# code types: name -> (NumPy dtype, code of missing values)
+BIN_TYPES = {
+  "int16": ('<i2', -2**15),
+  "int32": ('<i4', -2**31),
+}
+
+def quantize_range (lo, hi, decimals=2):
+  """ (scale, offset, code type) mapping [lo, hi] onto integer codes in
+  steps of 10^-decimals, so values are kept exactly.
+
+  Codes are int16 where the range is narrow enough and int32 otherwise.
+  """
+  scale = 10**-decimals
+  if lo > hi:
+    return scale, 0.0, "int16"
+  offset = round((lo + hi) / 2, decimals)
+  steps = max(hi - offset, offset - lo) / scale
+  for code_type, (dtype, missing) in BIN_TYPES.items():
+    # one code spare for rounding, besides the missing one
+    if steps <= -missing - 2:
+      return scale, offset, code_type
+  raise ValueError("Range %s-%s too wide for %d decimals" % (lo, hi, decimals))
+
+def compact_binary (combine_file, bin_file, decimals=2):
+  """ Write the data.csv table as integer codes for the map front end.
+
+  The file is BIN_MAGIC, the length of a JSON header (uint32), the header
+  padded to an even length and the codes of each column in turn, all
+  little-endian. The header lists row ids, the missing value code of each
+  code type in BIN_TYPES and, per column, the name, code type, decimals,
+  scale and offset of value = code * scale + offset.
+  """
+  value_columns, csv_header = csv_schema(combine_file)
+  combine = read_table(combine_file, value_columns)
+  stats = ["mean", "sd", "min", "max"]
+  sds = [sds_to_dict(combine["sds"][name.rsplit("/", 1)[0]]) for name in value_columns]
+
+  def column_values (c):
+    column = np.array([round(x, decimals) for x in combine["columns"][value_columns[c]].tolist()])
+    extra = [np.nan if sds[c][stat] is None else round(sds[c][stat], decimals) for stat in stats]
+    return np.append(column, extra)
+
+  write_binary(bin_file, combine["ids"] + stats, csv_header[1:], column_values, decimals)
+
+def csv_to_binary (csv_file, bin_file, decimals=2):
+  """ Same as compact_binary(), from the data.csv that compact_combine()
+  wrote, for when the combined table isn't at hand """
+  with open(csv_file, 'r', newline='') as f:
+    reader = csv.reader(f, dialect='unix')
+    csv_header = next(reader)
+    rows = list(reader)
+  values = np.array([[float(x) if x != '' else np.nan for x in row[1:]] for row in rows])
+  write_binary(bin_file, [row[0] for row in rows], csv_header[1:], lambda c: values[:, c], decimals)
+
+def write_binary (bin_file, rows, names, column_values, decimals=2):
+  """ Write columns in the compact_binary() format.
+
+  column_values(c) returns the values of column c, one per row, NaN
+  where missing. It is called twice per column, so that columns needn't
+  all be held at once.
+  """
+  columns = []
+  for c, name in enumerate(names):
+    values = column_values(c)
+    present = values[~np.isnan(values)]
+    lo, hi = (present.min(), present.max()) if len(present) else (np.inf, -np.inf)
+    scale, offset, code_type = quantize_range(float(lo), float(hi), decimals)
+    columns.append({"name": name, "type": code_type, "scale": scale, "offset": offset, "decimals": decimals})
+
+  header = json.dumps({
+    "rows": rows,
+    "columns": columns,
+    "missing": {code_type: missing for code_type, (dtype, missing) in BIN_TYPES.items()},
+  }, ensure_ascii=False).encode('utf8')
+  header += b" " * (len(header) % 2)
+  tmp_filename = "%s.%d.tmp" % (bin_file, os.getpid())
+  with open(tmp_filename, 'wb') as f:
+    f.write(BIN_MAGIC)
+    f.write(struct.pack('<I', len(header)))
+    f.write(header)
+    for c, column in enumerate(columns):
+      values = column_values(c)
+      dtype, missing = BIN_TYPES[column["type"]]
+      codes = np.full(len(values), missing, dtype=dtype)
+      present = ~np.isnan(values)
+      codes[present] = np.rint((values[present] - column["offset"]) / column["scale"])
+      f.write(codes.tobytes())
+  os.replace(tmp_filename, bin_file)
 
 def get_compact_geojson_filename (election):
   return "%s_geo.json" % election
 
+def encode_features (features, precision=5):
+  """ Features with their geometry polyline-encoded """
+  return [{
+    "type": "Feature",
+    "properties": feature["properties"],
+    "geometry": encode_geometry(feature["geometry"], precision),
+  } for feature in features]
+
+def build_geojson (election, workers=None):
+  """ Compact GeoJSON of election districts, straight from the shapefile.
+
+  Same output as shape_to_geojson() followed by compact_geojson(),
+  without the intermediate .geojson file. With workers (geo_workers by
+  default) > 1, features are encoded in that many processes.
+  """
+  if workers is None:
+    workers = geo_workers
+  output_filename = get_compact_geojson_filename(election)
+  features = geo_features(election)
+  if workers > 1 and len(features) > 1:
+    size = -(-len(features) // workers)
+    with ProcessPoolExecutor(workers) as pool:
+      chunks = pool.map(encode_features, [features[i:i+size] for i in range(0, len(features), size)])
+      features = [feature for chunk in chunks for feature in chunk]
+  else:
+    features = encode_features(features)
+
+  with open(output_filename, 'w') as f:
+    json.dump({
+      "type": "FeatureCollection",
+      "crs": {"type": "name", "properties": {"name": "urn:ogc:def:crs:OGC:1.3:CRS84"}},
+      "features": features,
+    }, f, ensure_ascii=False)
+
+def get_geo_level_filename (election, level):
+  return "%s_geo_%s.json" % (election, level)
+
+def encode_geometry (geometry, precision=5):
+  """ Polyline-encode the rings of a GeoJSON (Multi)Polygon geometry """
+  if geometry["type"] not in ("Polygon", "MultiPolygon"):
+    return geometry
+  polygons = geometry_rings(geometry)
+  lines = iter(polyline_codec.encode_rings([ring for polygon in polygons for ring in polygon], precision))
+  coordinates = [[next(lines) for ring in polygon] for polygon in polygons]
+  if geometry["type"] == "Polygon":
+    coordinates = coordinates[0]
+  return {"type": geometry["type"], "coordinates": coordinates}
+
+def decode_geometry (geometry, precision=5):
+  """ Inverse of encode_geometry() """
+  if geometry["type"] not in ("Polygon", "MultiPolygon"):
+    return geometry
+  polygons = geometry_rings(geometry)
+  rings = iter(polyline_codec.decode_rings([ring for polygon in polygons for ring in polygon], precision))
+  coordinates = [[next(rings).tolist() for ring in polygon] for polygon in polygons]
+  if geometry["type"] == "Polygon":
+    coordinates = coordinates[0]
+  return {"type": geometry["type"], "coordinates": coordinates}
+
+def read_compact_geojson (election):
+  """ Districts of the compact GeoJSON from build_geojson() as a
+  GeoDataFrame indexed by district id """
+  with open(get_compact_geojson_filename(election), 'r') as f:
+    data = json.load(f)
+  precision = data.get("precision", 5)
+  sf = gpd.GeoDataFrame.from_features([{
+    "type": "Feature",
+    "properties": feature["properties"],
+    "geometry": decode_geometry(feature["geometry"], precision),
+  } for feature in data["features"]], crs="OGC:CRS84")
+  return sf.set_index("index")
+
+def geo_features (election, level=None, properties=None, compact=False):
+  """ GeoJSON features of election districts in WGS84, "index" first.
+
+  Districts are read from the shapefile or, with compact, from the
+  compact GeoJSON built from it, so that files derived from that one
+  match it whether or not the shapefile is at hand. With a level,
+  borders are simplified in geo_crs per geo_levels[level] (shared ones
+  once for both neighbours, with shapely.coverage_simplify, so no gaps
+  or overlaps open up between districts). properties limits the
+  properties kept besides the index.
+  """
+  if compact:
+    sf = read_compact_geojson(election)
+  else:
+    sf = gpd.read_file(shape_paths[election])
+    fields = id_fields[election]
+    sf.index = [':'.join([process_id_field(x) for x in p]) for p in zip(*[list(b) for a, b in sf[fields].items()])]
+    sf.index.name = "index"
+  if level is not None:
+    tolerance, precision = geo_levels[level]
+    sf.to_crs(geo_crs, inplace=True)
+    # simplification may leave rings either way round, while the shapefiles
+    # and the full-detail files have exterior rings clockwise
+    simplified = shpl.orient_polygons(shpl.coverage_simplify(sf.geometry.values, tolerance), exterior_cw=True)
+    sf.geometry = gpd.GeoSeries(simplified, index=sf.index, crs=sf.crs)
+  sf.to_crs(epsg=4326, inplace=True)
+  features = sf.reset_index().__geo_interface__["features"]
+  if properties is not None:
+    for feature in features:
+      feature["properties"] = {k: feature["properties"][k] for k in ["index"] + properties if k in feature["properties"]}
+  return features
+
+def simplify_geojson (election, level):
+  """ Compact GeoJSON of election districts simplified per geo_levels[level].
+
+  Coordinates are polyline-encoded with the level's precision, stored as
+  "precision" in the output.
+  """
+  tolerance, precision = geo_levels[level]
+  output = {
+    "type": "FeatureCollection",
+    "precision": precision,
+    "features": [],
+  }
+  for feature in geo_features(election, level, geo_level_properties, compact=True):
+    output["features"].append({
+      "type": "Feature",
+      "properties": feature["properties"],
+      "geometry": encode_geometry(feature["geometry"], precision),
+    })
+  with open(get_geo_level_filename(election, level), 'w') as f:
+    json.dump(output, f, ensure_ascii=False)
+
+def get_topology_filename (election, level=None):
+  if level is None:
+    return "%s_topo.json" % election
+  return "%s_topo_%s.json" % (election, level)
+
+def geometry_rings (geometry):
+  """ Rings of a GeoJSON (Multi)Polygon as a nested list like its coordinates """
+  if geometry["type"] == "Polygon":
+    return [geometry["coordinates"]]
+  elif geometry["type"] == "MultiPolygon":
+    return geometry["coordinates"]
+  return []
+
+def extract_arcs (rings):
+  """ Cut rings of integer points where they meet other rings and keep
+  every piece of border once.
+
+  Returns (arcs, refs): arcs as lists of points and, for each ring, the
+  indices of the arcs it is made of, ~i for arc i traversed backwards.
+  """
+  # a point is a junction if rings pass it with different neighbours
+  neighbours = {}
+  junctions = set()
+  for ring in rings:
+    n = len(ring)
+    for i, point in enumerate(ring):
+      pair = {ring[i - 1], ring[(i + 1) % n]}
+      seen = neighbours.setdefault(point, pair)
+      if seen != pair:
+        junctions.add(point)
+
+  arcs = []
+  arc_index = {}
+  def add_arc (points):
+    key = tuple(points)
+    if key in arc_index:
+      return arc_index[key]
+    reverse_key = key[::-1]
+    if reverse_key in arc_index:
+      return ~arc_index[reverse_key]
+    arc_index[key] = len(arcs)
+    arcs.append(points)
+    return arc_index[key]
+
+  refs = []
+  for ring in rings:
+    cuts = [i for i, point in enumerate(ring) if point in junctions]
+    if not cuts:
+      # a ring sharing no junction is one closed arc, started at its
+      # smallest point so that any ring matching it gets the same arc
+      start = ring.index(min(ring))
+      points = ring[start:] + ring[:start]
+      reverse = points[:1] + points[:0:-1]
+      key = tuple(points + points[:1])
+      reverse_key = tuple(reverse + reverse[:1])
+      if reverse_key in arc_index and key not in arc_index:
+        refs.append([~arc_index[reverse_key]])
+      else:
+        refs.append([add_arc(points + points[:1])])
+      continue
+    points = ring[cuts[0]:] + ring[:cuts[0]] + ring[cuts[0]:cuts[0] + 1]
+    cuts = [i - cuts[0] for i in cuts] + [len(ring)]
+    refs.append([add_arc(points[cuts[k]:cuts[k + 1] + 1]) for k in range(len(cuts) - 1)])
+  return arcs, refs
+
+def topology_geojson (election, level=None):
+  """ Districts as a TopoJSON-style topology: every shared border is
+  stored once as an arc and polygons list the arcs of their rings.
+
+  Coordinates are quantized to the polyline precision of the level (5
+  for full detail) and arcs are polyline-encoded, so each point is a
+  delta from the previous one.
+  """
+  precision = 5 if level is None else geo_levels[level][1]
+  features = geo_features(election, level, None if level is None else geo_level_properties, compact=True)
+
+  rings = []
+  for feature in features:
+    for polygon in geometry_rings(feature["geometry"]):
+      for ring in polygon:
+        points = [tuple(p) for p in polyline_codec.quantize(ring, precision).tolist()]
+        # drop the closing point and repeats left by quantization
+        points = [p for i, p in enumerate(points[:-1]) if p != points[i - 1] or i == 0]
+        if len(points) > 1 and points[-1] == points[0]:
+          points = points[:-1]
+        rings.append(points)
+  arcs, refs = extract_arcs(rings)
+
+  output = {
+    "type": "Topology",
+    "precision": precision,
+    "arcs": polyline_codec.encode_quantized(arcs),
+    "objects": [],
+  }
+  r = 0
+  for feature in features:
+    polygons = []
+    for polygon in geometry_rings(feature["geometry"]):
+      polygons.append(refs[r:r + len(polygon)])
+      r += len(polygon)
+    output["objects"].append({
+      "type": feature["geometry"]["type"],
+      "properties": feature["properties"],
+      "arcs": polygons[0] if feature["geometry"]["type"] == "Polygon" else polygons,
+    })
+  with open(get_topology_filename(election, level), 'w') as f:
+    json.dump(output, f, ensure_ascii=False)
+
+def get_tile_dir (election):
+  return os.path.join("tiles", election)
+
+def get_tile_index_filename (election):
+  return os.path.join(get_tile_dir(election), "index.json")
+
+def tile_xy (lon, lat, zoom):
+  """ Web Mercator tile x, y at zoom containing lon, lat """
+  n = 2**zoom
+  lat = np.radians(lat)
+  x = np.floor((np.asarray(lon) + 180) / 360 * n).astype(int)
+  y = np.floor((1 - np.arcsinh(np.tan(lat)) / np.pi) / 2 * n).astype(int)
+  return np.clip(x, 0, n - 1), np.clip(y, 0, n - 1)
+
+def tile_bounds (x, y, zoom):
+  """ (west, south, east, north) of a Web Mercator tile """
+  n = 2**zoom
+  lat = lambda y: np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * y / n))))
+  return x / n * 360 - 180, lat(y + 1), (x + 1) / n * 360 - 180, lat(y)
+
+def tile_geojson (election):
+  """ Cut the boundaries of election districts into static tiles for
+  each zoom in geo_tile_zooms, as tiles/<election>/<z>/<x>/<y>.json.
+
+  Every district goes whole into each tile it touches, encoded like
+  simplify_geojson() output. index.json lists the zooms with their tiles
+  and is written last.
+  """
+  tile_dir = get_tile_dir(election)
+  tmp_dir = "%s.%d.tmp" % (tile_dir, os.getpid())
+  shutil.rmtree(tmp_dir, ignore_errors=True)
+  index = {"zooms": {}}
+  for zoom, level in geo_tile_zooms.items():
+    precision = 5 if level is None else geo_levels[level][1]
+    features = geo_features(election, level, geo_level_properties, compact=True)
+    geoms = np.array([shpl.geometry.shape(feature["geometry"]) for feature in features])
+    encoded = [{
+      "type": "Feature",
+      "properties": feature["properties"],
+      "geometry": encode_geometry(feature["geometry"], precision),
+    } for feature in features]
+
+    bounds = shpl.bounds(geoms)
+    x0, y0 = tile_xy(bounds[:, 0], bounds[:, 3], zoom)
+    x1, y1 = tile_xy(bounds[:, 2], bounds[:, 1], zoom)
+    tiles = {}
+    for i in range(len(geoms)):
+      for x in range(x0[i], x1[i] + 1):
+        for y in range(y0[i], y1[i] + 1):
+          tiles.setdefault((x, y), []).append(i)
+
+    kept = []
+    for (x, y), members in sorted(tiles.items()):
+      box = shpl.box(*tile_bounds(x, y, zoom))
+      members = [i for i in members if shpl.intersects(geoms[i], box)]
+      if not members:
+        continue
+      os.makedirs(os.path.join(tmp_dir, str(zoom), str(x)), exist_ok=True)
+      with open(os.path.join(tmp_dir, str(zoom), str(x), "%d.json" % y), 'w') as f:
+        json.dump({
+          "type": "FeatureCollection",
+          "precision": precision,
+          "features": [encoded[i] for i in members],
+        }, f, ensure_ascii=False)
+      kept.append([x, y])
+    index["zooms"][zoom] = {"level": level, "tiles": kept}
+
+  os.makedirs(tmp_dir, exist_ok=True)
+  with open(os.path.join(tmp_dir, "index.json"), 'w') as f:
+    json.dump(index, f, ensure_ascii=False)
+  shutil.rmtree(tile_dir, ignore_errors=True)
+  os.makedirs(os.path.dirname(tile_dir), exist_ok=True)
+  os.replace(tmp_dir, tile_dir)
+
 def compact_geojson (election):
   filename = get_geojson_filename(election)
   output_filename = get_compact_geojson_filename(election)
   with open(filename, 'r') as f:
     data = json.load(f)
 
-  for f, feature in enumerate(data["features"]):
-    for l, line in enumerate(feature["geometry"]["coordinates"]):
-      if feature["geometry"]["type"] == "Polygon":
-        data["features"][f]["geometry"]["coordinates"][l] = polyline.encode(line, geojson=True)
-      elif feature["geometry"]["type"] == "MultiPolygon":
-        for p, pline in enumerate(line):
-          data["features"][f]["geometry"]["coordinates"][l][p] = polyline.encode(pline, geojson=True)
+  for feature in data["features"]:
+    feature["geometry"] = encode_geometry(feature["geometry"])
 
   with open(output_filename, 'w') as f:
     json.dump(data, f, ensure_ascii=False)
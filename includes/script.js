@@ -34,7 +34,6 @@ var id_layer_map = {};
 var election_input;
 var absolute_values_input;
 var compass_cloud = {};
-import { polyline } from './polyline.min.js';
 
 const base_style = {
   "weight": 1,
@@ -636,19 +635,209 @@ function updateThemeDescription() {
   }
 }
 
-function loadGeoJson(data) {
-  data.features.forEach((feature, f) => {
-    feature.geometry.coordinates.forEach((line, l) => {
-      if (feature.geometry.type == "Polygon") {
-        data.features[f].geometry.coordinates[l] = polyline.toGeoJSON(line).coordinates;
-      } else if (feature.geometry.type == "MultiPolygon") {
-        line.forEach((pline, p) => {
-          data.features[f].geometry.coordinates[l][p] = polyline.toGeoJSON(pline).coordinates;
-        });
+// boundary levels, coarsest first, each as alternative files: the first
+// level available is drawn and the rest replace its geometry once the
+// map is up
+const geo_files = [
+  ['2024_LRS_topo_coarse.json', '2024_LRS_geo_coarse.json'],
+  ['2024_LRS_topo.json', '2024_LRS_geo.json'],
+];
+
+// full-detail boundary tiles, used instead of the finer geo_files levels
+// when present: once the map is zoomed in to a tile zoom, the tiles in
+// view refine the areas they cover over the first level drawn
+const geo_tiles = 'tiles/2024_LRS/';
+let tile_index;
+const loaded_tiles = new Set();
+const layer_tile_zoom = {};
+
+// same as polyline.toGeoJSON(line, precision).coordinates without
+// the intermediate [lat, lng] arrays
+function decodeLine(line, precision) {
+  const factor = Math.pow(10, Number.isInteger(precision) ? precision : 5);
+  const coordinates = [];
+  let index = 0, lat = 0, lng = 0;
+  while (index < line.length) {
+    let byte, shift = 1, result = 0;
+    do {
+      byte = line.charCodeAt(index++) - 63;
+      result += (byte & 31) * shift;
+      shift *= 32;
+    } while (byte >= 32);
+    lat += result & 1 ? (-result - 1) / 2 : result / 2;
+    shift = 1;
+    result = 0;
+    do {
+      byte = line.charCodeAt(index++) - 63;
+      result += (byte & 31) * shift;
+      shift *= 32;
+    } while (byte >= 32);
+    lng += result & 1 ? (-result - 1) / 2 : result / 2;
+    coordinates.push([lng / factor, lat / factor]);
+  }
+  return coordinates;
+}
+
+function decodeGeometry(geometry, precision) {
+  if (geometry.type == "Polygon") {
+    return geometry.coordinates.map(line => decodeLine(line, precision));
+  } else if (geometry.type == "MultiPolygon") {
+    return geometry.coordinates.map(poly => poly.map(pline => decodeLine(pline, precision)));
+  }
+  return geometry.coordinates;
+}
+
+// Topology: polyline-encoded arcs shared between polygons, which list
+// them per ring by index, ~i standing for arc i reversed
+function decodeTopology(topology) {
+  const arcs = topology.arcs.map(arc => decodeLine(arc, topology.precision));
+  const ring = refs => {
+    let coordinates = [];
+    refs.forEach(ref => {
+      const arc = arcs[ref < 0 ? ~ref : ref];
+      const start = coordinates.length ? 1 : 0;
+      for (let i=start; i<arc.length; i++) {
+        coordinates.push(ref < 0 ? arc[arc.length - 1 - i] : arc[i]);
+      }
+    });
+    return coordinates;
+  };
+  return {
+    type: "FeatureCollection",
+    features: topology.objects.map(object => ({
+      type: "Feature",
+      properties: object.properties,
+      geometry: {
+        type: object.type,
+        coordinates: object.type == "Polygon"
+          ? object.arcs.map(ring)
+          : object.arcs.map(poly => poly.map(ring)),
+      },
+    })),
+  };
+}
+
+function decodeGeoJson(data) {
+  if (data.type == "Topology") {
+    return decodeTopology(data);
+  }
+  data.features.forEach(feature => {
+    feature.geometry.coordinates = decodeGeometry(feature.geometry, data.precision);
+  });
+  return data;
+}
+
+function fetchGeoJson(file) {
+  return fetch(file)
+    .then(response => {
+      if (!response.ok) {
+        throw new Error(response.status);
+      }
+      return response.json();
+    })
+    .then(data => decodeGeoJson(data));
+}
+
+function fetchGeoLevel(files) {
+  let loaded = Promise.reject();
+  files.forEach(file => {
+    loaded = loaded.catch(() => fetchGeoJson(file));
+  });
+  return loaded;
+}
+
+function loadGeoLevels(levels) {
+  let loaded = Promise.reject();
+  levels.forEach((files, i) => {
+    loaded = loaded.catch(() => fetchGeoLevel(files).then(data => {
+      loadGeoJson(data);
+      return i;
+    }));
+  });
+  return loaded;
+}
+
+function refineGeoLevels(levels) {
+  return levels.reduce((promise, files) => promise
+    .then(() => fetchGeoLevel(files))
+    .then(data => refineGeoJson(data))
+    .catch(() => {}), Promise.resolve());
+}
+
+function refineLayer(layer, feature) {
+  const depth = feature.geometry.type == "Polygon" ? 1 : 2;
+  layer.setLatLngs(L.GeoJSON.coordsToLatLngs(feature.geometry.coordinates, depth));
+}
+
+function refineGeoJson(data) {
+  data.features.forEach(feature => {
+    const layer = id_layer_map[feature.properties.index];
+    if (!layer) return;
+    refineLayer(layer, feature);
+  });
+}
+
+function tileXY(latlng, zoom) {
+  const n = Math.pow(2, zoom);
+  const lat = latlng.lat * Math.PI / 180;
+  const x = Math.floor((latlng.lng + 180) / 360 * n);
+  const y = Math.floor((1 - Math.asinh(Math.tan(lat)) / Math.PI) / 2 * n);
+  return [x, y];
+}
+
+function loadTileIndex() {
+  return fetch(geo_tiles + 'index.json')
+    .then(response => {
+      if (!response.ok) {
+        throw new Error(response.status);
       }
+      return response.json();
+    })
+    .then(index => {
+      tile_index = index;
     });
+}
+
+function addGeoTile(data, zoom) {
+  data.features.forEach(feature => {
+    const id = feature.properties.index;
+    const layer = id_layer_map[id];
+    if (!layer) {
+      geojson.addData(feature);
+    } else if (!(layer_tile_zoom[id] >= zoom)) {
+      refineLayer(layer, feature);
+    } else {
+      return;
+    }
+    layer_tile_zoom[id] = zoom;
   });
+}
+
+function updateGeoTiles() {
+  const zoom = Object.keys(tile_index.zooms).map(Number)
+    .sort((a, b) => a - b)
+    .filter(z => z <= map.getZoom())
+    .pop();
+  if (zoom === undefined) {
+    return Promise.resolve();
+  }
+
+  const bounds = map.getBounds();
+  const [x0, y0] = tileXY(bounds.getNorthWest(), zoom);
+  const [x1, y1] = tileXY(bounds.getSouthEast(), zoom);
+  const promises = [];
+  tile_index.zooms[zoom].tiles.forEach(([x, y]) => {
+    const key = `${zoom}/${x}/${y}`;
+    if (x < x0 || x > x1 || y < y0 || y > y1 || loaded_tiles.has(key)) return;
+    loaded_tiles.add(key);
+    promises.push(fetchGeoJson(`${geo_tiles}${key}.json`)
+      .then(data => addGeoTile(data, zoom))
+      .catch(() => loaded_tiles.delete(key)));
+  });
+  return Promise.all(promises);
+}
 
+function loadGeoJson(data) {
   geojson = L.geoJson(data,
     {
       style: base_style,
@@ -672,57 +861,96 @@ function loadGeoJson(data) {
   geojson.bindTooltip(getTooltip, {sticky: true});
 }
 
+const sds_keys = ["mean", "sd", "min", "max"];
+
+function setDataValue (apl_id, field, election, value) {
+  let is_sds = sds_keys.includes(apl_id);
+  let category = Object.keys(value_labels).includes(field)
+    ? "values"
+    : "votes";
+  if (is_sds) {
+    if (!content.sds) {
+      content.sds = {};
+    }
+    if (!content.sds[category]) {
+      content.sds[category] = {};
+    }
+    if (!content.sds[category][field]) {
+      content.sds[category][field] = {};
+    }
+    if (!content.sds[category][field][election]) {
+      content.sds[category][field][election] = {};
+    }
+    content.sds[category][field][election][apl_id] = value;
+  } else {
+    if (!content[apl_id]) {
+      content[apl_id] = {};
+    }
+    if (!content[apl_id][category]) {
+      content[apl_id][category] = {};
+    }
+    if (!content[apl_id][category][field]) {
+      content[apl_id][category][field] = {};
+    }
+    if (!content[apl_id][category][field][election]) {
+      content[apl_id][category][field][election] = {};
+    }
+    content[apl_id][category][field][election]["value"] = value;
+  }
+}
+
 function loadDataArray (data) {
   const header = data[0];
-  const values = Object.keys(value_labels);
-  const sds_keys = ["mean", "sd", "min", "max"];
   for (let r=1; r<data.length; r++) {
     let row = data[r];
     let apl_id = row[0];
-    let is_sds = sds_keys.includes(apl_id);
-    if (!content[apl_id] && !is_sds) {
-      content[apl_id] = {};
-    }
     for (let i=1; i<row.length; i++) {
-      let field, election, category, value;
+      let field, election, value;
       [field, election] = header[i].split('|');
-      category = values.includes(field)
-        ? "values"
-        : "votes";
       value = row[i] == ''
         ? null
         : parseFloat(row[i]);
-      
-      if (is_sds) {
-        if (!content.sds) {
-          content.sds = {};
-        }
-        if (!content.sds[category]) {
-          content.sds[category] = {};
-        }
-        if (!content.sds[category][field]) {
-          content.sds[category][field] = {};
-        }
-        if (!content.sds[category][field][election]) {
-          content.sds[category][field][election] = {};
-        }
-        content.sds[category][field][election][apl_id] = value;
-      } else {
-        if (!content[apl_id][category]) {
-          content[apl_id][category] = {};
-        }
-        if (!content[apl_id][category][field]) {
-          content[apl_id][category][field] = {};
-        }
-        if (!content[apl_id][category][field][election]) {
-          content[apl_id][category][field][election] = {};
-        }
-        content[apl_id][category][field][election]["value"] = value;
-      }
+      setDataValue(apl_id, field, election, value);
     }
   }
 }
 
+// data.bin: "RNK1", header length (uint32), JSON header padded to an
+// even length, then int16 or int32 codes column by column;
+// value = code * scale + offset, rounded to the column's decimals
+function loadDataBinary (buffer) {
+  const view = new DataView(buffer);
+  const header_length = view.getUint32(4, true);
+  const header = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 8, header_length)));
+  const rows = header.rows;
+  let offset = 8 + header_length;
+  header.columns.forEach(column => {
+    let field, election;
+    [field, election] = column.name.split('|');
+    const factor = Math.pow(10, column.decimals);
+    const missing = header.missing[column.type];
+    const size = column.type == "int32" ? 4 : 2;
+    for (let r=0; r<rows.length; r++) {
+      let code = size == 4 ? view.getInt32(offset, true) : view.getInt16(offset, true);
+      offset += size;
+      let value = null;
+      if (code != missing) {
+        value = Math.round((code * column.scale + column.offset) * factor) / factor;
+      }
+      setDataValue(rows[r], field, election, value);
+    }
+  });
+}
+
+function loadDataCSV () {
+  return fetch('data.csv')
+    .then(response => response.text())
+    .then(data => {
+      let parsed_data = data.csvToArray({rSep:"\n"});
+      loadDataArray(parsed_data);
+    });
+}
+
 function loadSummary (data) {
   Object.keys(data).forEach(apl_id => {
     if (apl_id == "sds") {
@@ -779,6 +1007,8 @@ function applyCurStyle() {
   }
 
   geojson.setStyle(style_def);
+  // for areas added later from boundary tiles
+  geojson.options.style = style_def;
 
   updateThemeDescription();
 }
@@ -1386,16 +1616,36 @@ window.addEventListener('load', async (event) => {
     }
   });
   
-  let geojson_promise = fetch('2024_LRS_geo.json')
-    .then(response => response.json())
-    .then(data => loadGeoJson(data));
+  let geojson_promise = loadGeoLevels(geo_files);
+
+  // tiles follow the map from as soon as there are layers to refine, so
+  // that a view set before init finishes (as from the URL) gets them too
+  let tiles_promise = Promise.all([
+    geojson_promise,
+    loadTileIndex().then(() => true).catch(() => false),
+  ]).then(([geo_level, tiled]) => {
+    if (!tiled || geo_level == geo_files.length - 1) {
+      return false;
+    }
+    map.addEventListener('moveend', () => updateGeoTiles());
+    updateGeoTiles();
+    return true;
+  });
 
-  let data_promise = fetch('data.csv')
-    .then(response => response.text())
-    .then(data => {
-      let parsed_data = data.csvToArray({rSep:"\n"});
-      loadDataArray(parsed_data);
-    });
+  let data_promise = fetch('data.bin')
+    .then(response => {
+      if (!response.ok) {
+        throw new Error(response.status);
+      }
+      return response.arrayBuffer();
+    })
+    .then(buffer => {
+      if (new TextDecoder().decode(new Uint8Array(buffer, 0, 4)) != "RNK1") {
+        throw new Error("unknown format");
+      }
+      loadDataBinary(buffer);
+    })
+    .catch(() => loadDataCSV());
 
   document.querySelectorAll('input[name=theme]').forEach(node => {
     node.addEventListener('change', e => {
@@ -1414,8 +1664,12 @@ window.addEventListener('load', async (event) => {
   election_input = getElectionInput();
   absolute_values_input = getAbsoluteValuesInput();
 
-  await geojson_promise;
+  let geo_level = await geojson_promise;
   await data_promise;
 
   onFullInit();
+
+  if (!(await tiles_promise)) {
+    refineGeoLevels(geo_files.slice(geo_level + 1));
+  }
 });
@@ -0,0 +1,107 @@
+"""
+Copyright 2024 Justas Lavišius <bucaneer@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+""" Google encoded polyline format over NumPy arrays.
+
+Coordinates are in GeoJSON (lon, lat) order, as with the geojson=True
+option of the polyline package, whose output this matches byte for byte.
+Functions taking lists of rings process them as one batch.
+"""
+
+import numpy as np
+
+def quantize (coordinates, precision=5):
+  """ Integer coordinates scaled by 10**precision, rounded half away
+  from zero like the polyline package """
+  scaled = np.asarray(coordinates, dtype=float)[..., :2] * int(10**precision)
+  return (np.sign(scaled) * np.floor(np.abs(scaled) + 0.5)).astype(np.int64)
+
+def encode_quantized (rings):
+  """ Encode rings of quantize()d (lon, lat) points """
+  if not len(rings):
+    return []
+  lengths = np.array([len(ring) for ring in rings])
+  points = np.concatenate([np.asarray(ring, dtype=np.int64).reshape(-1, 2) for ring in rings])
+  # deltas from the previous point of the same ring, lat first
+  deltas = np.diff(points[:, ::-1], axis=0, prepend=0)
+  starts = np.cumsum(lengths) - lengths
+  starts = starts[lengths > 0]
+  deltas[starts] = points[starts, ::-1]
+  values = deltas.ravel()
+  values = np.where(values < 0, ~(values << 1), values << 1)
+
+  # 5-bit chunks, low first, with 0x20 set on all but the last
+  chunks = 1
+  while (values >> (5 * chunks)).any():
+    chunks += 1
+  shifts = 5 * np.arange(chunks)
+  counts = 1 + (values[:, None] >= (1 << shifts[1:])).sum(axis=1)
+  parts = (values[:, None] >> shifts) & 31
+  parts[np.arange(chunks) < counts[:, None] - 1] |= 32
+  chars = (parts + 63)[np.arange(chunks) < counts[:, None]].astype(np.uint8)
+
+  text = chars.tobytes().decode("ascii")
+  offsets = np.concatenate([[0], np.cumsum(counts)])
+  ends = offsets[2 * np.cumsum(lengths)]
+  begins = offsets[2 * (np.cumsum(lengths) - lengths)]
+  return [text[b:e] for b, e in zip(begins.tolist(), ends.tolist())]
+
+def encode_rings (rings, precision=5):
+  """ Encode rings of (lon, lat) coordinates, one string per ring """
+  return encode_quantized([quantize(ring, precision).reshape(-1, 2) for ring in rings])
+
+def encode (coordinates, precision=5):
+  """ Encode one line of (lon, lat) coordinates """
+  return encode_rings([coordinates], precision)[0]
+
+def decode_rings (lines, precision=5):
+  """ Decode polyline strings into (n, 2) arrays of (lon, lat) """
+  if not len(lines):
+    return []
+  text = "".join(lines).encode("ascii")
+  chars = np.frombuffer(text, dtype=np.uint8).astype(np.int64) - 63
+  value_ends = np.flatnonzero(chars < 32)
+  if not len(value_ends):
+    return [np.zeros((0, 2)) for line in lines]
+  value_starts = np.concatenate([[0], value_ends[:-1] + 1])
+  # position of each chunk within its value
+  position = np.arange(len(chars)) - np.repeat(value_starts, value_ends - value_starts + 1)
+  values = np.add.reduceat((chars & 31) << (5 * position), value_starts)
+  values = np.where(values & 1, ~(values >> 1), values >> 1)
+
+  # values per line from the number of value ends among its characters
+  char_ends = np.cumsum([len(line) for line in lines])
+  value_counts = np.diff(np.searchsorted(value_ends, char_ends), prepend=0)
+  deltas = values.reshape(-1, 2)
+  points = np.cumsum(deltas, axis=0)
+  point_ends = np.cumsum(value_counts // 2)
+  point_starts = point_ends - value_counts // 2
+  factor = float(10**precision)
+  output = []
+  for start, end in zip(point_starts, point_ends):
+    base = points[start - 1] if start > 0 else 0
+    output.append((points[start:end] - base)[:, ::-1] / factor)
+  return output
+
+def decode (line, precision=5):
+  """ Decode one polyline string into an (n, 2) array of (lon, lat) """
+  return decode_rings([line], precision)[0]